@@ -1,31 +1,42 @@
-import boto3
-from celery import Celery
 from datetime import datetime
 import os
-import requests
-import yaml
 
 from flask import Flask, render_template
 from flask import session as current_session
 from flask_mail import Mail
-from flask_migrate import Migrate, MigrateCommand
-from flask.sessions import SessionInterface
-from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 from flask_user import user_logged_out
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.local import LocalProxy
 
-from beaker.cache import CacheManager
-from beaker.util import parse_cache_config_options
-from beaker.middleware import SessionMiddleware
+from app.extensions.cache import AppCache
+from app.extensions.database import RoutingSQLAlchemy, configure_engines
+from app.utils.config_snapshot import ConfigSnapshot
+from app.utils.profiling import StartupTimer
+
+# Heavier libraries (boto3, requests, yaml, celery and beaker) are imported by the functions that need them,
+# so processes that never use a feature do not pay to load it. "manage.py startup-profile" shows the costs.
 
 # Instantiate Flask extensions
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 csrf_protect = CSRFProtect()
 mail = Mail()
 migrate = Migrate()
 
 
-def get_config():
+_config = None
+_secret_snapshots = {}
+
+
+def get_config(refresh=False):
+    """Return the resolved base configuration, building it only once per process unless `refresh` is set"""
+    global _config
+    if _config is None or refresh:
+        _config = load_config()
+    return dict(_config)
+
+
+def load_config():
     # Instantiate Flask
     app = Flask(__name__)
 
@@ -37,10 +48,10 @@ def get_config():
         app.config.from_envvar(os.environ['APPLICATION_SETTINGS'])
     # Load extra config settings from the AWS Secrets Manager
     if 'AWS_SECRETS_MANAGER_CONFIG' in os.environ:
-        secret_config = get_secrets(os.environ['AWS_SECRETS_MANAGER_CONFIG'])
+        secret_config = load_secrets(os.environ['AWS_SECRETS_MANAGER_CONFIG'], app.config)
         app.config.update(secret_config)
-    elif 'AWS_SECRETS_MANAGER_CONFIG' in app.config:
-        secret_config = get_secrets(app.config['AWS_SECRETS_MANAGER_CONFIG'])
+    elif app.config.get('AWS_SECRETS_MANAGER_CONFIG', False):
+        secret_config = load_secrets(app.config['AWS_SECRETS_MANAGER_CONFIG'], app.config)
         app.config.update(secret_config)
     # Load extra config settings from environment- note that the config key must exist in app.config to get picked up
     for setting in app.config:
@@ -57,10 +68,24 @@ def get_config():
     return app.config
 
 
+def load_secrets(secret_name, config):
+    """Return a secret's settings, using the in-process or on-disk snapshot while it is fresh enough.
+
+    Snapshots are written to CONFIG_SNAPSHOT_PATH, when set, and expire after CONFIG_SNAPSHOT_TTL seconds."""
+    if secret_name not in _secret_snapshots:
+        setting = lambda name, default: os.environ.get(name, config.get(name, default))
+        _secret_snapshots[secret_name] = ConfigSnapshot(secret_name, lambda: get_secrets(secret_name),
+                                                        path=setting('CONFIG_SNAPSHOT_PATH', False) or None,
+                                                        ttl=float(setting('CONFIG_SNAPSHOT_TTL', 300)),
+                                                        key=setting('CONFIG_SNAPSHOT_KEY', False) or None)
+    return _secret_snapshots[secret_name].get()
+
+
 def get_secrets(secret_name, region=False):
+    import yaml
     if not region:
         region = get_secret_region()
-    client = boto3.client(service_name='secretsmanager', region_name=region)
+    client = get_secrets_client(region)
 
     # Depending on whether the secret was a string or binary, one of these fields will be populated
     get_secret_value_response = client.get_secret_value(SecretId=secret_name)
@@ -72,6 +97,13 @@ def get_secrets(secret_name, region=False):
     return yaml.safe_load(secret)
 
 
+def get_secrets_client(region):
+    import boto3
+    # AWS_SECRETS_MANAGER_ENDPOINT points the client at a local Secrets Manager stub, such as moto, for testing.
+    return boto3.client(service_name='secretsmanager', region_name=region,
+                        endpoint_url=os.environ.get('AWS_SECRETS_MANAGER_ENDPOINT') or None)
+
+
 def get_secret_region():
     """Extrapolate the preferred region when one isn't supplied"""
     # Check for specific environmental variable.
@@ -79,11 +111,13 @@ def get_secret_region():
         return os.environ['AWS_SECRETS_REGION']
 
     # Check for boto3/awscli default region.
+    import boto3
     boto3_session = boto3.session.Session()
     if boto3_session.region_name:
         return boto3_session.region_name
 
     # If this is being called from an EC2 instance use its region.
+    import requests
     r = requests.get('http://169.254.169.254/latest/dynamic/instance-identity/document', timeout=0.2)
     r.raise_for_status()
     data = r.json()
@@ -94,13 +128,27 @@ def get_secret_region():
 base_config = get_config()
 
 # Initiate Services
-celery = Celery(__name__, broker=base_config['CELERY_BROKER'])
-cache = None # Initiate below, but define here for scope reasons.
+_celery = None
+
+
+def get_celery():
+    """Return the Celery application, creating it the first time it is needed"""
+    global _celery
+    if _celery is None:
+        from celery import Celery
+        _celery = Celery(__name__, broker=base_config['CELERY_BROKER'], task_cls='app.tasks.base:AppTask')
+    return _celery
+
+
+celery = LocalProxy(get_celery)
+cache = AppCache() # Configured by init_cache_manager() once the app exists.
 
 
 def create_app(extra_config_settings={}):
     """Create a Flask applicaction.
     """
+    timer = StartupTimer()
+
     # Instantiate Flask
     app = Flask(__name__)
 
@@ -110,9 +158,18 @@ def create_app(extra_config_settings={}):
     # Load extra config settings from 'extra_config_settings' param
     app.config.update(extra_config_settings)
 
+    # Apply the configured password hash cost to Flask-User's passlib context
+    if app.config.get('PASSWORD_HASH_ROUNDS', False):
+        schemes = app.config.get('USER_PASSLIB_CRYPTCONTEXT_SCHEMES', ['bcrypt'])
+        keywords = dict(app.config.get('USER_PASSLIB_CRYPTCONTEXT_KEYWORDS', {}))
+        keywords['%s__default_rounds' % schemes[0]] = int(app.config['PASSWORD_HASH_ROUNDS'])
+        app.config['USER_PASSLIB_CRYPTCONTEXT_KEYWORDS'] = keywords
+    timer.mark('config')
+
     # Setup Flask-Extensions -- do this _after_ app config has been loaded
 
-    # Setup Flask-SQLAlchemy
+    # Setup Flask-SQLAlchemy, with pool settings and any read replicas
+    configure_engines(app)
     db.init_app(app)
 
     # Setup Flask-Migrate
@@ -123,15 +180,26 @@ def create_app(extra_config_settings={}):
 
     # Setup WTForms CSRFProtect
     csrf_protect.init_app(app)
+    timer.mark('extensions')
 
     # Setup Cache
-    cache = init_cache_manager(app)
+    init_cache_manager(app)
+    timer.mark('cache')
 
     # Setup Session Manager
     init_session_manager(app)
+    timer.mark('sessions')
 
     # Setup Celery
     init_celery_service(app)
+    timer.mark('celery')
+
+    # Setup request, SQL, password and LDAP metrics and, in debug and test mode, query tracking
+    from app.extensions.metrics import init_metrics
+    init_metrics(app)
+    from app.extensions.query_tracking import init_query_tracking
+    init_query_tracking(app)
+    timer.mark('metrics')
 
     # Add HTTP Error pages
     init_error_handlers(app)
@@ -150,6 +218,7 @@ def create_app(extra_config_settings={}):
     from app.views.apis import api_blueprint
     app.register_blueprint(api_blueprint)
     csrf_protect.exempt(api_blueprint)
+    timer.mark('blueprints')
 
 
     # Setup an error-logger to send emails to app.config.ADMINS
@@ -163,6 +232,8 @@ def create_app(extra_config_settings={}):
 
     #user_manager = UserManager(app, db, User)
     user_manager = TedivmUserManager(app, db, User)
+    timer.mark('user manager')
+    app.extensions['startup_timings'] = timer.stages
 
     return app
 
@@ -186,11 +257,12 @@ def init_email_error_handler(app):
     to_addr_list = app.config['ADMINS']
     subject = app.config.get('APP_SYSTEM_ERROR_SUBJECT_LINE', 'System Error')
 
-    # Setup an SMTP mail handler for error-level messages
+    # Setup an SMTP mail handler for error-level messages. Errors are queued and sent from a background thread, with
+    # identical errors grouped into one summary per ERROR_EMAIL_WINDOW and at most ERROR_EMAIL_MAX_PER_HOUR emails.
     import logging
-    from logging.handlers import SMTPHandler
+    from app.extensions.error_mail import ErrorDigestHandler, ErrorQueueHandler, SummarySMTPHandler
 
-    mail_handler = SMTPHandler(
+    smtp_handler = SummarySMTPHandler(
         mailhost=(host, port),  # Mail host and port
         fromaddr=from_addr,  # From address
         toaddrs=to_addr_list,  # To address
@@ -198,6 +270,15 @@ def init_email_error_handler(app):
         credentials=(username, password),  # Credentials
         secure=secure,
     )
+    digest_handler = ErrorDigestHandler(
+        smtp_handler,
+        subject=subject,
+        window=app.config.get('ERROR_EMAIL_WINDOW', 60),
+        max_emails=app.config.get('ERROR_EMAIL_MAX_PER_HOUR', 12),
+        max_groups=app.config.get('ERROR_EMAIL_MAX_GROUPS', 20),
+    )
+    digest_handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+    mail_handler = ErrorQueueHandler(digest_handler, maxsize=app.config.get('ERROR_EMAIL_QUEUE_SIZE', 1000))
     mail_handler.setLevel(logging.ERROR)
     app.logger.addHandler(mail_handler)
 
@@ -210,7 +291,7 @@ def init_cache_manager(app):
     if 'CACHE_TYPE' not in app.config or not app.config['CACHE_TYPE']:
         app.config['CACHE_TYPE'] = 'file'
 
-    if app.config['CACHE_TYPE'] is 'file':
+    if app.config['CACHE_TYPE'] == 'file':
         if 'CACHE_ROOT' not in app.config or not app.config['CACHE_ROOT']:
             app.config['CACHE_ROOT'] = '/tmp/%s' % __name__
 
@@ -223,11 +304,32 @@ def init_cache_manager(app):
     if 'CACHE_URL' in app.config and app.config['CACHE_URL']:
         cache_opts['cache.url'] = app.config['CACHE_URL']
 
-
-    cache = CacheManager(**parse_cache_config_options(cache_opts))
+    cache.init_app(app, cache_opts)
+    return cache
 
 
 def init_session_manager(app):
+    backend = app.config.get('SESSION_BACKEND', 'beaker')
+    if backend == 'cookie':
+        from app.extensions.sessions import CookieSessionInterface
+        app.session_interface = CookieSessionInterface(app.config.get('SESSION_COOKIE_EXPIRES', 86400))
+    elif backend == 'database':
+        from app.extensions.sessions import DatabaseSessionInterface
+        app.session_interface = DatabaseSessionInterface(
+            cookie_expires=app.config.get('SESSION_COOKIE_EXPIRES', 86400),
+            refresh_interval=app.config.get('SESSION_REFRESH_INTERVAL', 3600))
+    else:
+        init_beaker_sessions(app)
+
+    @user_logged_out.connect_via(app)
+    def clear_session(sender, user, **extra):
+        current_session.clear()
+
+
+def init_beaker_sessions(app):
+    from beaker.middleware import SessionMiddleware
+    from app.extensions.sessions import BeakerSessionInterface
+
     session_opts = {'cache.expire': 3600}
 
     if 'CACHE_TYPE' not in app.config or not app.config['CACHE_TYPE']:
@@ -245,29 +347,62 @@ def init_session_manager(app):
     if 'CACHE_URL' in app.config and app.config['CACHE_URL']:
         session_opts['session.url'] = app.config['CACHE_URL']
 
-    session_opts['session.auto'] = app.config.get('SESSION_AUTO', True)
+    session_opts['session.auto'] = app.config.get('SESSION_AUTO', False)
+    session_opts['session.save_accessed_time'] = False  # BeakerSessionInterface decides when a refresh is due.
     session_opts['session.cookie_expires'] = app.config.get('SESSION_COOKIE_EXPIRES', 86400)
     session_opts['session.secret'] = app.secret_key
 
-    class BeakerSessionInterface(SessionInterface):
-        def open_session(self, app, request):
-            session = request.environ['beaker.session']
-            return session
-
-        def save_session(self, app, session, response):
-            session.save()
-
     app.wsgi_app = SessionMiddleware(app.wsgi_app, session_opts)
-    app.session_interface = BeakerSessionInterface()
-
-    @user_logged_out.connect_via(app)
-    def clear_session(sender, user, **extra):
-        current_session.clear()
+    app.session_interface = BeakerSessionInterface(
+        refresh_interval=app.config.get('SESSION_REFRESH_INTERVAL', 3600))
 
 
 def init_celery_service(app):
+    # Web processes without a broker never send tasks, so they skip loading Celery entirely.
+    if not app.config.get('CELERY_BROKER', False):
+        return
+
     celery.conf.update(app.config)
 
+    # Tasks run in this app, each with a fresh application context and database session.
+    from app.tasks.base import bind_app
+    bind_app(app)
+
+    beat_schedule = {}
+    if app.config.get('USER_LDAP', False) and app.config.get('LDAP_SYNC_INTERVAL', False):
+        beat_schedule['sync-ldap-directory'] = {
+            'task': 'app.tasks.ldap.sync_ldap_directory',
+            'schedule': float(app.config['LDAP_SYNC_INTERVAL']),
+        }
+    if app.config.get('USER_LDAP', False) and app.config.get('LDAP_SYNC_FULL_INTERVAL', False):
+        beat_schedule['full-sync-ldap-directory'] = {
+            'task': 'app.tasks.ldap.sync_ldap_directory',
+            'schedule': float(app.config['LDAP_SYNC_FULL_INTERVAL']),
+            'kwargs': {'full': True},
+        }
+    if app.config.get('SESSION_BACKEND', 'beaker') == 'database' and app.config.get('SESSION_PURGE_INTERVAL', False):
+        beat_schedule['purge-expired-sessions'] = {
+            'task': 'app.tasks.sessions.purge_expired_sessions',
+            'schedule': float(app.config['SESSION_PURGE_INTERVAL']),
+        }
+    if app.config.get('API_RATE_LIMIT_BACKEND', 'memory') == 'database' and \
+            app.config.get('API_RATE_LIMIT_PURGE_INTERVAL', False):
+        beat_schedule['purge-rate-limit-buckets'] = {
+            'task': 'app.tasks.rate_limit.purge_rate_limit_buckets',
+            'schedule': float(app.config['API_RATE_LIMIT_PURGE_INTERVAL']),
+        }
+    if app.config.get('MAIL_DRAIN_INTERVAL', False):
+        beat_schedule['drain-queued-mail'] = {
+            'task': 'app.tasks.mail.send_messages',
+            'schedule': float(app.config['MAIL_DRAIN_INTERVAL']),
+        }
+    if app.config.get('CACHE_TYPE') == 'file' and app.config.get('CACHE_SWEEP_INTERVAL', False):
+        beat_schedule['sweep-cache-files'] = {
+            'task': 'app.tasks.cache.sweep_cache_files',
+            'schedule': float(app.config['CACHE_SWEEP_INTERVAL']),
+        }
+    celery.conf.beat_schedule = beat_schedule
+
 
 def init_error_handlers(app):
 
@@ -286,6 +421,11 @@ def init_error_handlers(app):
     def error_pagenotfound(e):
         return show_error(404, 'Page not found.')
 
+    @app.errorhandler(429)
+    def error_toomanyrequests(e):
+        headers = {'Retry-After': str(e.retry_after)} if getattr(e, 'retry_after', None) else {}
+        return show_error(429, 'Too many requests.') + (headers,)
+
     @app.errorhandler(500)
     def error_servererror(e):
         return show_error(500, 'An unknown error has occurred on the server.')
@@ -0,0 +1,49 @@
+# This file defines password hashing commands for manage.py
+
+import re
+import time
+
+from passlib.context import CryptContext
+
+
+def time_hash(scheme, rounds, samples=3):
+    """ Return the median number of milliseconds it takes to hash a password at the given cost """
+    context = CryptContext(schemes=[scheme], **{'%s__default_rounds' % scheme: rounds})
+    timings = []
+    for sample in range(samples):
+        start = time.perf_counter()
+        context.hash('benchmark-password')
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def benchmark_rounds(target_ms, scheme='bcrypt', min_rounds=10, max_rounds=16, report=None):
+    """ Find the highest cost factor whose hash time stays within target_ms on this machine, never below min_rounds """
+    best = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        elapsed = time_hash(scheme, rounds)
+        if report:
+            report(rounds, elapsed)
+        if elapsed > target_ms:
+            break
+        best = rounds
+    return best
+
+
+def write_setting(path, name, value):
+    """ Set `name = value` in a python settings file, replacing an existing assignment if there is one """
+    line = '%s = %r\n' % (name, value)
+    try:
+        with open(path) as settings_file:
+            contents = settings_file.read()
+    except FileNotFoundError:
+        contents = ''
+    pattern = re.compile(r'^%s\s*=.*$\n?' % re.escape(name), re.MULTILINE)
+    if pattern.search(contents):
+        contents = pattern.sub(line, contents, count=1)
+    else:
+        if contents and not contents.endswith('\n'):
+            contents += '\n'
+        contents += line
+    with open(path, 'w') as settings_file:
+        settings_file.write(contents)
@@ -4,12 +4,16 @@
 #
 # Authors: Ling Thio <ling.thio@gmail.com>
 
+import csv
 import datetime
+import json
+import multiprocessing
 
 from flask import current_app
+from passlib.context import CryptContext
 
 from app import db
-from app.models.user_models import User, Role
+from app.models.user_models import User, Role, UsersRoles
 
 
 def find_or_create_role(name, label):
@@ -41,3 +45,163 @@ def find_or_create_user(first_name, last_name, username, email, password, role=N
         db.session.add(user)
         db.session.commit()
     return user
+
+
+def read_user_records(input_file, input_format='csv'):
+    """ Stream user records from a CSV or JSON Lines file, in the layout written by export-users """
+    if input_format == 'jsonl':
+        records = (json.loads(line) for line in input_file if line.strip())
+    else:
+        records = csv.DictReader(input_file)
+    for record in records:
+        roles = record.get('roles') or []
+        if isinstance(roles, str):
+            roles = [role for role in roles.split(';') if role]
+        record['roles'] = roles
+        yield record
+
+
+def import_users(records, batch_size=1000, processes=None, update_passwords=False, progress=None):
+    """ Create or update users in batches, keyed on username or email
+
+    Passwords for new users (and, with update_passwords, existing ones) are hashed in a process pool using the
+    application's passlib configuration. Role assignments are only ever added, so re-running an import is safe.
+    Records without a username or email are skipped, and new users without a password are rejected.
+    """
+    context_config = current_app.user_manager.password_manager.password_crypt_context.to_string()
+    totals = {'created': 0, 'updated': 0, 'skipped': 0, 'rejected': 0}
+    role_ids = {}
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, batch_size // (processes * 4))
+    pool = multiprocessing.Pool(processes, initializer=_init_password_hasher, initargs=(context_config,))
+    try:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                _import_user_batch(batch, pool, chunksize, role_ids, update_passwords, totals)
+                batch = []
+                if progress:
+                    progress(totals)
+        if batch:
+            _import_user_batch(batch, pool, chunksize, role_ids, update_passwords, totals)
+            if progress:
+                progress(totals)
+    finally:
+        pool.close()
+        pool.join()
+    return totals
+
+
+_password_context = None
+
+
+def _init_password_hasher(context_config):
+    global _password_context
+    _password_context = CryptContext.from_string(context_config)
+
+
+def _hash_password(password):
+    return _password_context.hash(password)
+
+
+def _import_user_batch(batch, pool, chunksize, role_ids, update_passwords, totals):
+    # Collapse records sharing a username or an email into one user. Later names and passwords win, roles are merged.
+    records, records_by_username, records_by_email = [], {}, {}
+    for record in batch:
+        username, email = record.get('username'), record.get('email')
+        if not username and not email:
+            totals['skipped'] += 1
+            continue
+        merged = records_by_username.get(username) or records_by_email.get(email)
+        if merged is None:
+            merged = dict(record, roles=list(record['roles']))
+            records.append(merged)
+        else:
+            for field in ('first_name', 'last_name'):
+                if record.get(field) is not None:
+                    merged[field] = record[field]
+            if record.get('password'):
+                merged['password'] = record['password']
+            merged['roles'] += [role for role in record['roles'] if role not in merged['roles']]
+            # Only fill in a missing username or email, and never with one that belongs to another record.
+            if not merged.get('username') and username and username not in records_by_username:
+                merged['username'] = username
+            if not merged.get('email') and email and email not in records_by_email:
+                merged['email'] = email
+        if merged.get('username'):
+            records_by_username.setdefault(merged['username'], merged)
+        if merged.get('email'):
+            records_by_email.setdefault(merged['email'], merged)
+
+    usernames = [record['username'] for record in records if record.get('username')]
+    emails = [record['email'] for record in records if record.get('email')]
+    existing_users = User.query.filter(db.or_(User.username.in_(usernames), User.email.in_(emails))).all()
+    by_username = {user.username: user for user in existing_users if user.username}
+    by_email = {user.email: user for user in existing_users if user.email}
+
+    new_records = []
+    rehash = []
+    for record in records:
+        user = by_username.get(record.get('username')) or by_email.get(record.get('email'))
+        if not user:
+            if not record.get('password'):
+                # New users need a password to be able to log in.
+                record['id'] = None
+                totals['rejected'] += 1
+                continue
+            new_records.append(record)
+            continue
+        for field in ('first_name', 'last_name'):
+            if record.get(field) is not None:
+                setattr(user, field, record[field])
+        if update_passwords and record.get('password'):
+            rehash.append((user, record['password']))
+        record['id'] = user.id
+        totals['updated'] += 1
+
+    to_hash = [record['password'] for record in new_records] + [password for user, password in rehash]
+    hashes = iter(pool.map(_hash_password, to_hash, chunksize))
+    new_hashes = [next(hashes) for record in new_records]
+    for user, password in rehash:
+        user.password = next(hashes)
+
+    now = datetime.datetime.utcnow()
+    db.session.bulk_insert_mappings(User, [{
+        'username': record.get('username') or None,
+        'email': record.get('email') or None,
+        'first_name': record.get('first_name') or '',
+        'last_name': record.get('last_name') or '',
+        'password': password_hash,
+        'active': True,
+        'email_confirmed_at': now,
+    } for record, password_hash in zip(new_records, new_hashes)])
+    totals['created'] += len(new_records)
+
+    # Look up the ids of the rows just inserted so their roles can be assigned.
+    new_usernames = [record['username'] for record in new_records if record.get('username')]
+    new_emails = [record['email'] for record in new_records if record.get('email') and not record.get('username')]
+    inserted = db.session.query(User.id, User.username, User.email)\
+        .filter(db.or_(User.username.in_(new_usernames), User.email.in_(new_emails)))
+    ids_by_key = {}
+    for user_id, username, email in inserted:
+        ids_by_key[username] = user_id
+        ids_by_key[email] = user_id
+    for record in new_records:
+        record['id'] = ids_by_key.get(record.get('username') or record.get('email'))
+
+    wanted = set()
+    for record in records:
+        if record['id'] is None:
+            continue
+        for role_name in record['roles']:
+            if role_name not in role_ids:
+                role_ids[role_name] = find_or_create_role(role_name, role_name).id
+            wanted.add((record['id'], role_ids[role_name]))
+    if wanted:
+        user_ids = list(set(user_id for user_id, role_id in wanted))
+        existing_pairs = set(db.session.query(UsersRoles.user_id, UsersRoles.role_id)
+                             .filter(UsersRoles.user_id.in_(user_ids)))
+        db.session.bulk_insert_mappings(UsersRoles, [{'user_id': user_id, 'role_id': role_id}
+                                                     for user_id, role_id in wanted - existing_pairs])
+    db.session.commit()
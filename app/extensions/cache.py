@@ -0,0 +1,148 @@
+from collections import Counter
+from functools import wraps
+import threading
+
+from app.utils.cache import TTLCache
+
+_missing = object()
+
+
+class CacheRegion(object):
+    """A named cache with its own expiry, backed by Beaker and fronted by a bounded in-process LRU.
+
+    The local tier only lives for CACHE_LOCAL_TTL seconds (capped at the region's expiry), which bounds how long
+    another process can serve a value after it was invalidated here."""
+
+    def __init__(self, name, backend, expire, local_size, local_ttl):
+        self.name = name
+        self.backend = backend
+        self.expire = expire
+        self.local = TTLCache(maxsize=local_size, ttl=min(local_ttl, expire) if expire else local_ttl)
+        self.counters = Counter()
+
+    def get(self, key, default=None):
+        key = str(key)
+        value = self.local.get(key, _missing)
+        if value is not _missing:
+            self.counters['local_hits'] += 1
+            return value
+        try:
+            value = self.backend.get(key)
+        except KeyError:
+            self.counters['misses'] += 1
+            return default
+        self.counters['backend_hits'] += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        key = str(key)
+        self.backend.put(key, value)
+        self.local.set(key, value)
+
+    def delete(self, key):
+        key = str(key)
+        self.local.delete(key)
+        self.backend.remove_value(key)
+
+    def clear(self):
+        self.local.clear()
+        self.backend.clear()
+
+    def get_or_create(self, key, createfunc):
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = createfunc()
+            self.set(key, value)
+        return value
+
+    def stats(self):
+        counters = dict(self.counters)
+        counters['local_size'] = len(self.local)
+        return counters
+
+
+class AppCache(object):
+    """Application cache made of named regions, each with a per-region expiry.
+
+        cache.region('users').get_or_create(user_id, lambda: load_user(user_id))
+
+        @cache.memoize('roles')
+        def role_choices():
+            ...
+    """
+
+    def __init__(self, app=None):
+        self.manager = None
+        self.default_expire = 3600
+        self.region_expires = {}
+        self.local_size = 1000
+        self.local_ttl = 30
+        self._regions = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, cache_opts=None):
+        from beaker.cache import CacheManager
+        from beaker.util import parse_cache_config_options
+
+        self.manager = CacheManager(**parse_cache_config_options(cache_opts or {}))
+        self.default_expire = int(app.config.get('CACHE_EXPIRE', 3600))
+        self.region_expires = dict(app.config.get('CACHE_REGIONS', None) or {})
+        self.local_size = int(app.config.get('CACHE_LOCAL_SIZE', 1000))
+        self.local_ttl = int(app.config.get('CACHE_LOCAL_TTL', 30))
+        with self._lock:
+            self._regions = {}
+        app.extensions['cache'] = self
+
+    def region(self, name):
+        region = self._regions.get(name)
+        if region is None:
+            if self.manager is None:
+                raise RuntimeError('The cache has not been initialized with init_app().')
+            with self._lock:
+                region = self._regions.get(name)
+                if region is None:
+                    expire = int(self.region_expires.get(name, self.default_expire))
+                    region = CacheRegion(name, self.manager.get_cache(name, expire=expire), expire,
+                                         self.local_size, self.local_ttl)
+                    self._regions[name] = region
+        return region
+
+    def get(self, region, key, default=None):
+        return self.region(region).get(key, default)
+
+    def set(self, region, key, value):
+        self.region(region).set(key, value)
+
+    def delete(self, region, key):
+        self.region(region).delete(key)
+
+    def invalidate(self, region):
+        """Drop every value in a region"""
+        self.region(region).clear()
+
+    def memoize(self, region, key=None):
+        """Cache a function's return value in `region`, keyed on its arguments or on `key(*args, **kwargs)`.
+
+        The wrapped function gains an `invalidate(*args, **kwargs)` method to drop a single entry."""
+        def decorator(function):
+            prefix = '%s.%s' % (function.__module__, function.__qualname__)
+
+            def make_key(*args, **kwargs):
+                if key is not None:
+                    return '%s:%s' % (prefix, key(*args, **kwargs))
+                return '%s:%r:%r' % (prefix, args, sorted(kwargs.items()))
+
+            @wraps(function)
+            def memoized(*args, **kwargs):
+                return self.region(region).get_or_create(make_key(*args, **kwargs), lambda: function(*args, **kwargs))
+
+            memoized.invalidate = lambda *args, **kwargs: self.region(region).delete(make_key(*args, **kwargs))
+            return memoized
+        return decorator
+
+    def stats(self):
+        """Hit and miss counters for every region used so far"""
+        return {name: region.stats() for name, region in list(self._regions.items())}
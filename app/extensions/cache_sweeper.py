@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+from flask import current_app
+import fcntl
+import os
+import time
+
+
+def sweep_cache_root(batch_size=500, pause=0.05):
+    """Delete expired Beaker session, cache and lock files below CACHE_ROOT and report what was reclaimed.
+
+    Only the file backend keeps one file per entry, so other cache types have nothing to sweep."""
+    config = current_app.config
+    if config.get('CACHE_TYPE', 'file') != 'file' or not config.get('CACHE_ROOT'):
+        return {}
+
+    from beaker.util import encoded_path
+
+    root = config['CACHE_ROOT']
+    session_age = int(config.get('SESSION_COOKIE_EXPIRES', 86400) or 86400)
+    cache_age = max([int(config.get('CACHE_EXPIRE', 3600) or 0)] +
+                    [int(expire or 0) for expire in (config.get('CACHE_REGIONS', None) or {}).values()])
+
+    # Beaker names a namespace's lock file after the sha1 of the namespace. Cache files are already named that way,
+    # session files are named after the raw session id.
+    session_lock_dir = os.path.join(root, 'session', 'container_file_lock')
+    session_lock = lambda path: encoded_path(session_lock_dir, [file_key(path)], extension='.lock')
+    cache_lock_dir = os.path.join(root, 'lock')
+    cache_lock = lambda path: encoded_path(cache_lock_dir, [file_key(path)], extension='.lock', digest_filenames=False)
+
+    stores = [
+        ('session', os.path.join(root, 'session', 'container_file'), '.cache', session_age, session_lock),
+        ('session_lock', session_lock_dir, '.lock', session_age, None),
+    ]
+    # A zero expiry means cached values never expire, so they are left alone.
+    if cache_age:
+        stores += [
+            ('data', os.path.join(root, 'data', 'container_file'), '.cache', cache_age, cache_lock),
+            ('lock', cache_lock_dir, '.lock', cache_age, None),
+        ]
+
+    return {name: sweep_files(directory, suffix, max_age, lock_path, batch_size=batch_size, pause=pause)
+            for name, directory, suffix, max_age, lock_path in stores}
+
+
+def sweep_files(directory, suffix, max_age, lock_path=None, batch_size=500, pause=0.05):
+    """Delete files below `directory` ending in `suffix` that were last written more than `max_age` seconds ago.
+
+    The tree is walked lazily and the sweep sleeps for `pause` seconds after every `batch_size` deletions, so it never
+    competes with request workers for long. Each file is only removed while holding its Beaker lock (or, for lock files,
+    the file itself) without waiting, so entries that are in use are skipped and counted as busy."""
+    result = {'files': 0, 'bytes': 0, 'busy': 0}
+    cutoff = time.time() - max_age
+    for path in iter_files(directory, suffix):
+        if not is_older(path, cutoff):
+            continue
+        with try_lock(lock_path(path) if lock_path else path, remove=lock_path is not None) as locked:
+            if not locked:
+                result['busy'] += 1
+                continue
+            # Look again now that nobody else can be writing it.
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > cutoff:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+        result['files'] += 1
+        result['bytes'] += stat.st_size
+        if result['files'] % batch_size == 0:
+            time.sleep(pause)
+    return result
+
+
+def iter_files(directory, suffix):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(suffix):
+                yield os.path.join(dirpath, filename)
+
+
+def is_older(path, cutoff):
+    try:
+        return os.stat(path).st_mtime <= cutoff
+    except FileNotFoundError:
+        return False
+
+
+def file_key(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+@contextmanager
+def try_lock(path, remove=False):
+    """Take an exclusive flock on `path` without blocking and yield whether it was acquired.
+
+    With `remove` the lock file is deleted again before it is released, as it only guarded the entry being swept."""
+    try:
+        descriptor = os.open(path, (os.O_CREAT | os.O_RDWR) if remove else os.O_RDONLY)
+    except FileNotFoundError:
+        yield False
+        return
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(descriptor)
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        if remove:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        os.close(descriptor)
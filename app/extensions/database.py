@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+from flask import current_app, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from functools import wraps
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+import random
+import time
+
+from app.utils.cache import request_cache
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+# Set on responses to requests that wrote, so the browser's next requests read their own writes from the primary.
+PRIMARY_COOKIE = 'db_primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """Sends reads to a replica while a request has asked for it with use_replica or replica_reads.
+
+    Flushes, Core insert, update and delete statements and every read after one of them in the same request go to the
+    primary, as do all reads within SQLALCHEMY_REPLICA_STICKY_SECONDS of a write by the same browser."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            mark_written()
+        elif replica_requested():
+            replica = get_replica_engine()
+            if replica is not None:
+                return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def configure_engines(app):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from the DATABASE_POOL_* settings and register replicas as binds"""
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', None) or {})
+    # SQLite connections are not pooled by size, Flask-SQLAlchemy picks a suitable pool for them itself.
+    if not app.config.get('SQLALCHEMY_DATABASE_URI', '').startswith('sqlite'):
+        if app.config.get('DATABASE_POOL_SIZE', False):
+            options.setdefault('pool_size', int(app.config['DATABASE_POOL_SIZE']))
+        if app.config.get('DATABASE_MAX_OVERFLOW', None) is not None:
+            options.setdefault('max_overflow', int(app.config['DATABASE_MAX_OVERFLOW']))
+    if app.config.get('DATABASE_POOL_PRE_PING', False):
+        options.setdefault('pool_pre_ping', True)
+    if app.config.get('DATABASE_POOL_RECYCLE', False):
+        options.setdefault('pool_recycle', int(app.config['DATABASE_POOL_RECYCLE']))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS', None) or {})
+    replicas = app.config.get('SQLALCHEMY_REPLICA_URIS', None) or []
+    if isinstance(replicas, str):
+        replicas = [uri.strip() for uri in replicas.split(',') if uri.strip()]
+    for index, uri in enumerate(replicas):
+        binds['%s%d' % (REPLICA_BIND_PREFIX, index)] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+    app.extensions['database_replicas'] = ['%s%d' % (REPLICA_BIND_PREFIX, index) for index in range(len(replicas))]
+
+    sticky = app.config.get('SQLALCHEMY_REPLICA_STICKY_SECONDS', 0)
+    if replicas and sticky:
+        @app.after_request
+        def stick_to_primary(response):
+            if request_cache('database').get('written'):
+                response.set_cookie(PRIMARY_COOKIE, str(int(time.time() + sticky)), max_age=sticky, httponly=True)
+            return response
+
+
+def get_replica_engine():
+    replicas = current_app.extensions.get('database_replicas')
+    if not replicas:
+        return None
+    # Stay on one replica for the whole request so its reads are consistent with each other.
+    state = request_cache('database')
+    if 'replica' not in state:
+        state['replica'] = random.choice(replicas)
+    from app import db
+    return db.get_engine(current_app, bind=state['replica'])
+
+
+def replica_requested():
+    state = request_cache('database')
+    if not state or not state.get('use_replica') or state.get('written'):
+        return False
+    try:
+        return int(request.cookies.get(PRIMARY_COOKIE, 0)) < time.time()
+    except ValueError:
+        return True
+
+
+def mark_written():
+    state = request_cache('database')
+    if state is not None:
+        state['written'] = True
+
+
+@contextmanager
+def replica_reads():
+    """Let queries in this block read from a replica, if any are configured"""
+    state = request_cache('database')
+    if state is None:
+        yield
+        return
+    previous = state.get('use_replica', False)
+    state['use_replica'] = True
+    try:
+        yield
+    finally:
+        state['use_replica'] = previous
+
+
+def use_replica(view_function):
+    """Serve a read only view from a replica. Put it directly below the route so the user loader is covered too."""
+    @wraps(view_function)
+    def decorated_view_function(*args, **kwargs):
+        with replica_reads():
+            return view_function(*args, **kwargs)
+    return decorated_view_function
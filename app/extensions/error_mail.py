@@ -0,0 +1,176 @@
+from collections import OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+import atexit
+import datetime
+import hashlib
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import traceback
+
+_address = re.compile(r'0x[0-9a-fA-F]+')
+_number = re.compile(r'\d+')
+
+
+def fingerprint(record):
+    """Identify a record by its exception type and traceback, or by its message with numbers and addresses removed"""
+    if record.exc_info and record.exc_info[2] is not None:
+        exc_type, exc, tb = record.exc_info
+        frames = [(frame.filename, frame.name, frame.lineno) for frame in traceback.extract_tb(tb)]
+        key = repr((exc_type.__module__, exc_type.__qualname__, frames))
+    else:
+        key = _number.sub('#', _address.sub('0x?', record.getMessage()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class SummarySMTPHandler(SMTPHandler):
+    """SMTPHandler that takes the subject from the summary record"""
+
+    def getSubject(self, record):
+        return getattr(record, 'subject', None) or self.subject
+
+
+class ErrorQueueHandler(QueueHandler):
+    """Hands error records to a background thread, so logging an error never waits on SMTP.
+
+    The queue and its thread are created by the first error in each process, as threads do not survive a fork. When the
+    queue is full records are dropped and counted in the next summary."""
+
+    def __init__(self, digest, maxsize=1000):
+        super(ErrorQueueHandler, self).__init__(None)
+        self.digest = digest
+        self.maxsize = maxsize
+        self.pid = None
+        self.listener = None
+
+    def prepare(self, record):
+        # The traceback is only available before the record is formatted for the queue.
+        record.fingerprint = fingerprint(record)
+        return super(ErrorQueueHandler, self).prepare(record)
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # The listener thread reads and resets the count while sending a summary.
+            self.digest.acquire()
+            try:
+                self.digest.dropped += 1
+            finally:
+                self.digest.release()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(self.maxsize)
+        self.digest.reset()
+        self.listener = QueueListener(self.queue, self.digest)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.digest.close()
+
+
+class ErrorDigestHandler(logging.Handler):
+    """Collects error records for `window` seconds and passes them to `target` as one summary record.
+
+    Identical errors are grouped and reported once with their count, up to `max_groups` kinds per summary. At most
+    `max_emails` summaries are sent per hour. Errors logged while over that limit are only counted, and reported in the
+    next summary once it may be sent."""
+
+    def __init__(self, target, subject='System Error', window=60, max_emails=12, max_groups=20):
+        super(ErrorDigestHandler, self).__init__()
+        self.target = target
+        self.subject = subject
+        self.window = window
+        self.max_emails = max_emails
+        self.max_groups = max_groups
+        self.sent = deque()
+        self.timer = None
+        self.reset()
+
+    def reset(self):
+        self.groups = OrderedDict()
+        self.omitted = 0
+        self.dropped = 0
+
+    def emit(self, record):
+        key = getattr(record, 'fingerprint', None) or fingerprint(record)
+        group = self.groups.get(key)
+        if group is not None:
+            group['count'] += 1
+            group['last'] = record.created
+        elif len(self.groups) < self.max_groups:
+            self.groups[key] = {'count': 1, 'first': record.created, 'last': record.created,
+                                'message': self.format(record)}
+        else:
+            self.omitted += 1
+        self.schedule(self.window)
+
+    def schedule(self, delay):
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.send_summary)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def send_summary(self):
+        self.acquire()
+        try:
+            self.timer = None
+            if not self.groups and not self.omitted and not self.dropped:
+                return
+            now = time.time()
+            while self.sent and self.sent[0] <= now - 3600:
+                self.sent.popleft()
+            if len(self.sent) >= self.max_emails:
+                self.schedule(self.sent[0] + 3600 - now)
+                return
+            summary = self.summarize()
+            self.sent.append(now)
+            self.reset()
+        finally:
+            self.release()
+        # Sent outside the lock, so new errors can be queued while the SMTP server is slow.
+        self.target.handle(summary)
+
+    def summarize(self):
+        total = sum(group['count'] for group in self.groups.values()) + self.omitted + self.dropped
+        lines = ['%d errors of %d kinds were logged on %s (pid %d).' % (
+            total, len(self.groups) + (1 if self.omitted else 0), os.uname()[1], os.getpid())]
+        if self.omitted:
+            lines.append('%d errors of other kinds are not shown.' % (self.omitted,))
+        if self.dropped:
+            lines.append('%d errors were dropped because the error queue was full.' % (self.dropped,))
+        for group in self.groups.values():
+            lines += ['', '=' * 78, '%d x, first at %s, last at %s' % (
+                group['count'], format_time(group['first']), format_time(group['last'])), '=' * 78, group['message']]
+        return logging.makeLogRecord({
+            'name': 'error_summary',
+            'levelno': logging.ERROR,
+            'levelname': 'ERROR',
+            'msg': '\n'.join(lines),
+            'subject': '%s (%d errors)' % (self.subject, total),
+        })
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.release()
+        self.send_summary()
+        super(ErrorDigestHandler, self).close()
+
+
+def format_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -1,28 +1,130 @@
 
-from flask import current_app, g
+from flask import current_app
 from flask_login import current_user
 from flask_user import UserManager
 from flask_user.forms import LoginForm
 from flask_user.translation_utils import lazy_gettext as _    # map _() to lazy_gettext()
 
+from contextlib import contextmanager
 import datetime
-from ldap3 import Server, Connection, ALL
+import os
+import queue
+import time
+from ldap3 import Server, Connection, NONE
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.utils.conv import escape_filter_chars
 from app import db
+from app.extensions.mail import CeleryEmailAdapter
+from app.extensions.metrics import track_duration
 from app.models import user_models
+from app.utils.cache import TTLCache, request_cache
+from app.utils.passwords import rehash_password_if_needed
+
+ROLE_SETTING_PREFIX = 'LDAP_GROUP_TO_ROLE_'
+
+
+class LdapConnectionPool(object):
+    """Process wide pool of connections bound as the LDAP service account.
+
+    Connections are checked out for a single operation and handed back afterwards. Ones that sat idle for
+    longer than `idle_timeout` are replaced, since directory servers tend to drop quiet sessions."""
+
+    def __init__(self, host, bind_dn, bind_password, size=10, idle_timeout=300,
+                 connect_timeout=None, receive_timeout=None, get_info=NONE):
+        self.server = Server(host, get_info=get_info, connect_timeout=connect_timeout)
+        self.bind_dn = bind_dn
+        self.bind_password = bind_password
+        self.idle_timeout = idle_timeout
+        self.receive_timeout = receive_timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self, user=None, password=None, auto_bind=True):
+        if user is None:
+            user, password = self.bind_dn, self.bind_password
+        return Connection(self.server, user, password, auto_bind=auto_bind, receive_timeout=self.receive_timeout)
+
+    @contextmanager
+    def connection(self):
+        conn = None
+        while conn is None:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+                break
+            if conn.closed or not conn.bound or time.monotonic() - last_used > self.idle_timeout:
+                discard_connection(conn)
+                conn = None
+
+        try:
+            yield conn
+        except BaseException:
+            discard_connection(conn)
+            raise
+
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            discard_connection(conn)
+
+    def search(self, search_base, search_filter, **kwargs):
+        """Run a search and return its entries, retrying once on a fresh connection if the server went away"""
+        with track_duration('ldap_search'):
+            try:
+                with self.connection() as conn:
+                    conn.search(search_base, search_filter, **kwargs)
+                    return conn.entries
+            except LDAPCommunicationError:
+                with self.connection() as conn:
+                    conn.search(search_base, search_filter, **kwargs)
+                    return conn.entries
+
+
+    def paged_search(self, search_base, search_filter, page_size=500, **kwargs):
+        """Yield raw result dictionaries from a paged search, holding one connection for the whole iteration"""
+        with self.connection() as conn:
+            for result in conn.extend.standard.paged_search(search_base, search_filter, paged_size=page_size,
+                                                            generator=True, **kwargs):
+                if result.get('type') == 'searchResEntry':
+                    yield result
+
+
+def discard_connection(conn):
+    try:
+        conn.unbind()
+    except Exception:
+        pass
+
+
+def get_connection_pool():
+    pool = current_app.extensions.get('ldap_pool')
+    # Connections must not be shared with processes forked after the pool was created.
+    if pool is None or pool.pid != os.getpid():
+        pool = LdapConnectionPool(current_app.config['LDAP_HOST'],
+                                  current_app.config['LDAP_BIND_DN'],
+                                  current_app.config['LDAP_BIND_PASSWORD'],
+                                  size=current_app.config.get('LDAP_POOL_SIZE', 10),
+                                  idle_timeout=current_app.config.get('LDAP_POOL_IDLE_TIMEOUT', 300),
+                                  connect_timeout=current_app.config.get('LDAP_CONNECT_TIMEOUT', None),
+                                  receive_timeout=current_app.config.get('LDAP_RECEIVE_TIMEOUT', None),
+                                  get_info=current_app.config.get('LDAP_SERVER_INFO', False) or NONE)
+        current_app.extensions['ldap_pool'] = pool
+    return pool
 
 
 def authenticate(user, password):
-    # define the server
-    s = Server(current_app.config['LDAP_HOST'], get_info=ALL)  # define an unsecure LDAP server, requesting info on DSE and schema
-
-    # define the connection
+    # Bind as the user on a dedicated connection - used to check user password.
     user_dn = get_dn_from_user(user)
-    c = Connection(current_app.config['LDAP_HOST'], user=user_dn, password=password)
-
-    # perform the Bind operation - used to check user password.
-    if not c.bind():
-        print('Unable to bind user %s' % (user_dn))
-        return False
+    c = get_connection_pool().connect(user_dn, password, auto_bind=False)
+    try:
+        with track_duration('ldap_bind'):
+            bound = c.bind()
+        if not bound:
+            print('Unable to bind user %s' % (user_dn))
+            return False
+    finally:
+        discard_connection(c)
 
     # check to see if user is actually a valid user.
     return True
@@ -32,32 +134,61 @@ def get_user_email(user):
     email_attribute = current_app.config.get('LDAP_EMAIL_ATTRIBUTE', False)
     if not email_attribute:
         return False
-    conn = get_bound_connection()
     user_search = get_dn_from_user(user)
     user_object = '(objectclass=%s)' % (current_app.config['LDAP_USER_OBJECT_CLASS'],)
-    conn.search(user_search, user_object, attributes=[email_attribute])
-    if len(conn.entries) < 1:
+    entries = get_connection_pool().search(user_search, user_object, attributes=[email_attribute])
+    if len(entries) < 1:
         return False
-    return getattr(conn.entries[0], email_attribute, False)[0]
+    return getattr(entries[0], email_attribute, False)[0]
 
 
 def user_in_group(user, group):
-    conn = get_bound_connection()
-    group_search = get_dn_from_group(group)
-    group_object = '(objectclass=%s)' % (current_app.config['LDAP_GROUP_OBJECT_CLASS'],)
-    conn.search(group_search, group_object, attributes=['memberUid'])
-    if len(conn.entries) < 1:
-        return False
-    members = conn.entries[0].memberUid
-    return user in members
+    return group in get_user_groups(user)
+
+
+def get_user_groups(user):
+    """Return the names of every group the user is a member of.
+
+    The result is memoized for the rest of the request and shared between requests for
+    LDAP_GROUP_CACHE_TTL seconds, so role checks only reach the directory once per user per expiry."""
+    request_groups = request_cache('ldap_user_groups')
+    if request_groups is not None and user in request_groups:
+        return request_groups[user]
 
+    group_cache = get_group_cache()
+    groups = group_cache.get(user)
+    if groups is None:
+        groups = search_user_groups(user)
+        group_cache.set(user, groups)
+    if request_groups is not None:
+        request_groups[user] = groups
+    return groups
 
-def get_bound_connection():
-    if 'ldap_connection' in g:
-        return g.ldap_connection
-    server = Server(current_app.config['LDAP_HOST'], get_info=ALL)  # define an unsecure LDAP server, requesting info on DSE and schema
-    g.ldap_connection = Connection(server, current_app.config['LDAP_BIND_DN'], current_app.config['LDAP_BIND_PASSWORD'], auto_bind=True)
-    return g.ldap_connection
+
+def get_group_cache():
+    if 'ldap_group_cache' not in current_app.extensions:
+        current_app.extensions['ldap_group_cache'] = TTLCache(
+            maxsize=current_app.config.get('LDAP_GROUP_CACHE_SIZE', 1024),
+            ttl=current_app.config.get('LDAP_GROUP_CACHE_TTL', 300))
+    return current_app.extensions['ldap_group_cache']
+
+
+def search_user_groups(user):
+    """Find all of a user's groups with a single reverse membership search"""
+    group_attribute = current_app.config['LDAP_GROUP_ATTRIBUTE']
+    group_object = '(&(objectclass=%s)(memberUid=%s))' % (current_app.config['LDAP_GROUP_OBJECT_CLASS'], escape_filter_chars(user))
+    entries = get_connection_pool().search(current_app.config['LDAP_GROUP_BASE'], group_object, attributes=[group_attribute])
+    groups = set()
+    for entry in entries:
+        groups.update(entry[group_attribute].values)
+    return frozenset(groups)
+
+
+def get_role_groups():
+    """Map role names to LDAP group names using the LDAP_GROUP_TO_ROLE_* settings"""
+    return {setting[len(ROLE_SETTING_PREFIX):].lower(): group
+            for setting, group in current_app.config.items()
+            if setting.startswith(ROLE_SETTING_PREFIX) and group}
 
 
 def get_dn_from_user(user):
@@ -111,6 +242,7 @@ class TedivmLoginForm(LoginForm):
 
         # Handle successful authentication
         if user and user_manager.verify_password(self.password.data, user.password):
+            rehash_password_if_needed(user, self.password.data)
             return True                         # Successful authentication
 
 
@@ -155,3 +287,12 @@ class TedivmLoginForm(LoginForm):
 class TedivmUserManager(UserManager):
     def customize(self, app):
         self.LoginFormClass = TedivmLoginForm
+        self.email_adapter = CeleryEmailAdapter(app)
+
+    def hash_password(self, password):
+        with track_duration('password_hash'):
+            return super(TedivmUserManager, self).hash_password(password)
+
+    def verify_password(self, password, password_hash):
+        with track_duration('password_verify'):
+            return super(TedivmUserManager, self).verify_password(password, password_hash)
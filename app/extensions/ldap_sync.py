@@ -0,0 +1,152 @@
+from flask import current_app
+
+import datetime
+from ldap3.utils.conv import escape_filter_chars
+from ldap3 import BASE
+from app import db
+from app.extensions.ldap import get_connection_pool, get_dn_from_group, get_role_groups
+from app.models.user_models import User, Role, UsersRoles, LdapSyncState
+from app.utils.api import revoke_api_tokens
+
+SYNC_STATE_NAME = 'directory'
+QUERY_CHUNK_SIZE = 500
+
+
+def sync_directory(full=False):
+    """Mirror LDAP users, emails and group memberships into the users, roles and users_roles tables.
+
+    Incremental runs only look at entries whose modifyTimestamp is at or after the newest one seen by the
+    previous run. Full runs read everything and also deactivate users that no longer exist in the directory."""
+    state = LdapSyncState.query.get(SYNC_STATE_NAME)
+    if not state:
+        state = LdapSyncState(name=SYNC_STATE_NAME)
+        db.session.add(state)
+    since = None if full else state.last_modified
+
+    users_synced, users_newest = sync_users(since, deactivate_missing=full)
+    roles_synced, roles_newest = sync_roles(since)
+
+    newest = latest(state.last_modified, users_newest, roles_newest)
+    state.last_modified = newest
+    state.synced_at = datetime.datetime.utcnow()
+    db.session.commit()
+    return {'users': users_synced, 'roles': roles_synced, 'last_modified': newest}
+
+
+def sync_users(since=None, deactivate_missing=False):
+    username_attribute = current_app.config['LDAP_USERNAME_ATTRIBUTE']
+    email_attribute = current_app.config.get('LDAP_EMAIL_ATTRIBUTE', False)
+    attributes = [username_attribute, 'modifyTimestamp']
+    if email_attribute:
+        attributes.append(email_attribute)
+
+    search_filter = modified_filter('(objectclass=%s)' % (current_app.config['LDAP_USER_OBJECT_CLASS'],), since)
+    results = get_connection_pool().paged_search(current_app.config['LDAP_USER_BASE'], search_filter,
+                                                 page_size=current_app.config.get('LDAP_SYNC_PAGE_SIZE', 500),
+                                                 attributes=attributes)
+    synced = 0
+    newest = None
+    seen = set()
+    batch = {}
+    for result in results:
+        username = first_value(result, username_attribute)
+        if not username:
+            continue
+        batch[username] = first_value(result, email_attribute) if email_attribute else None
+        newest = latest(newest, first_value(result, 'modifyTimestamp'))
+        if len(batch) >= QUERY_CHUNK_SIZE:
+            synced += upsert_users(batch)
+            seen.update(batch)
+            batch = {}
+    if batch:
+        synced += upsert_users(batch)
+        seen.update(batch)
+
+    missing = []
+    if deactivate_missing:
+        active_users = db.session.query(User.id, User.username).filter(User.username.isnot(None), User.active == True)
+        missing = [user_id for user_id, username in active_users if username not in seen]
+        for offset in range(0, len(missing), QUERY_CHUNK_SIZE):
+            User.query.filter(User.id.in_(missing[offset:offset + QUERY_CHUNK_SIZE]))\
+                .update({User.active: False}, synchronize_session=False)
+    db.session.commit()
+    revoke_api_tokens(*missing)
+    return synced, newest
+
+
+def upsert_users(emails_by_username):
+    existing = {user.username: user for user in User.query.filter(User.username.in_(list(emails_by_username)))}
+    now = datetime.datetime.utcnow()
+    for username, email in emails_by_username.items():
+        user = existing.get(username)
+        if not user:
+            db.session.add(User(username=username, email=email, active=True, email_confirmed_at=now))
+            continue
+        if email and user.email != email:
+            user.email = email
+        user.active = True
+    db.session.flush()
+    return len(emails_by_username)
+
+
+def sync_roles(since=None):
+    """Rebuild the membership of every role whose mapped LDAP group changed"""
+    synced = 0
+    newest = None
+    changed = set()
+    group_object = '(objectclass=%s)' % (current_app.config['LDAP_GROUP_OBJECT_CLASS'],)
+    for role_name, group in get_role_groups().items():
+        entries = list(get_connection_pool().paged_search(get_dn_from_group(group), modified_filter(group_object, since),
+                                                          search_scope=BASE, attributes=['memberUid', 'modifyTimestamp']))
+        if not entries:
+            continue
+        members = entries[0]['raw_attributes'].get('memberUid', [])
+        changed.update(set_role_members(role_name, [member.decode('utf-8') for member in members]))
+        newest = latest(newest, first_value(entries[0], 'modifyTimestamp'))
+        synced += 1
+    db.session.commit()
+    # Bearer tokens carry the roles they were issued with, so replace those of everyone whose roles changed.
+    revoke_api_tokens(*changed)
+    return synced, newest
+
+
+def set_role_members(role_name, usernames):
+    """Make the given users the only members of a role, returning the ids of users who gained or lost it"""
+    role = Role.query.filter(Role.name == role_name).first()
+    if not role:
+        role = Role(name=role_name, label=role_name)
+        db.session.add(role)
+        db.session.flush()
+
+    wanted = set()
+    for offset in range(0, len(usernames), QUERY_CHUNK_SIZE):
+        chunk = usernames[offset:offset + QUERY_CHUNK_SIZE]
+        wanted.update(user_id for (user_id,) in db.session.query(User.id).filter(User.username.in_(chunk)))
+    current = set(user_id for (user_id,) in db.session.query(UsersRoles.user_id).filter(UsersRoles.role_id == role.id))
+
+    removed = list(current - wanted)
+    for offset in range(0, len(removed), QUERY_CHUNK_SIZE):
+        db.session.query(UsersRoles).filter(UsersRoles.role_id == role.id,
+                                            UsersRoles.user_id.in_(removed[offset:offset + QUERY_CHUNK_SIZE]))\
+            .delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(UsersRoles, [{'user_id': user_id, 'role_id': role.id} for user_id in wanted - current])
+    return wanted ^ current
+
+
+def modified_filter(search_filter, since):
+    if not since:
+        return search_filter
+    return '(&%s(modifyTimestamp>=%s))' % (search_filter, escape_filter_chars(since))
+
+
+def latest(*stamps):
+    """Return the newest of the given generalizedTime strings, ignoring empty ones"""
+    stamps = [stamp for stamp in stamps if stamp]
+    return max(stamps) if stamps else None
+
+
+def first_value(result, attribute):
+    values = result['raw_attributes'].get(attribute)
+    if not values:
+        return None
+    return values[0].decode('utf-8')
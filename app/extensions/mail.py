@@ -0,0 +1,111 @@
+from flask import current_app
+from flask_mail import Attachment, Message
+from flask_user.email_adapters import EmailAdapterInterface
+import base64
+import smtplib
+import threading
+import time
+
+# Open SMTP connections, kept per thread because smtplib connections can not be shared between threads.
+_connections = threading.local()
+
+MESSAGE_FIELDS = ('subject', 'recipients', 'body', 'html', 'sender', 'cc', 'bcc', 'reply_to', 'date', 'charset',
+                  'extra_headers', 'mail_options', 'rcpt_options')
+
+
+class CeleryEmailAdapter(EmailAdapterInterface):
+    """Sends Flask-User's emails through send_message, so requests only enqueue them when a broker is configured"""
+
+    def send_email_message(self, recipient, subject, html_message, text_message, sender_email, sender_name):
+        sender = '"%s" <%s>' % (sender_name, sender_email) if sender_name else sender_email
+        send_message(Message(subject, sender=sender, recipients=[recipient], html=html_message, body=text_message))
+
+
+def send_message(message):
+    """Send a Flask-Mail message from a worker when CELERY_BROKER is set, or straight away when it is not"""
+    from app import celery
+    if current_app.config.get('CELERY_BROKER', False) and not celery.conf.task_always_eager:
+        from app.tasks.mail import send_messages
+        return send_messages.enqueue(message_to_dict(message))
+    # Only workers send batches often enough to reuse a connection, so don't hold one open in a web process.
+    try:
+        return deliver([message])
+    finally:
+        close_connection()
+
+
+def deliver(messages):
+    """Send messages over this thread's SMTP connection, which stays open for later batches.
+
+    A connection the server has dropped is replaced once per message. Messages whose recipients are all refused are
+    logged and skipped, as sending them again would fail the same way."""
+    sent = 0
+    for message in messages:
+        try:
+            try:
+                get_connection().send(message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                close_connection()
+                get_connection().send(message)
+        except smtplib.SMTPRecipientsRefused as e:
+            current_app.logger.warning('Dropped email %r, recipients refused: %s', message.subject, e.recipients)
+            continue
+        _connections.last_used = time.monotonic()
+        sent += 1
+    return sent
+
+
+def get_connection():
+    from app import mail
+
+    connection = getattr(_connections, 'connection', None)
+    if connection is not None:
+        idle = time.monotonic() - _connections.last_used
+        if connection.mail is not current_app.extensions['mail'] or \
+                idle > current_app.config.get('MAIL_CONNECTION_IDLE_TIMEOUT', 60):
+            close_connection()
+            connection = None
+    if connection is None:
+        connection = mail.connect()
+        connection.__enter__()
+        _connections.connection = connection
+        _connections.last_used = time.monotonic()
+    return connection
+
+
+def close_connection():
+    connection = getattr(_connections, 'connection', None)
+    _connections.connection = None
+    if connection is None or connection.host is None:
+        return
+    try:
+        connection.host.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.host.close()
+
+
+def message_to_dict(message):
+    data = {field: getattr(message, field) for field in MESSAGE_FIELDS}
+    # Keep the Message-ID, so a message sent again after a failed batch can be recognised as a duplicate.
+    data['msgId'] = message.msgId
+    data['attachments'] = [{
+        'filename': attachment.filename,
+        'content_type': attachment.content_type,
+        'data': base64.b64encode(attachment.data if isinstance(attachment.data, bytes)
+                                 else attachment.data.encode('utf-8')).decode('ascii'),
+        'disposition': attachment.disposition,
+        'headers': attachment.headers,
+    } for attachment in message.attachments]
+    return data
+
+
+def message_from_dict(data):
+    data = dict(data)
+    msg_id = data.pop('msgId', None)
+    attachments = [Attachment(attachment['filename'], attachment['content_type'], base64.b64decode(attachment['data']),
+                              attachment['disposition'], attachment['headers'])
+                   for attachment in data.pop('attachments', [])]
+    message = Message(attachments=attachments, **data)
+    if msg_id:
+        message.msgId = msg_id
+    return message
@@ -0,0 +1,136 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from flask import current_app, request, abort, Response
+import hmac
+import os
+import time
+
+from app.utils.cache import request_cache
+
+# Metrics are registered with prometheus_client's global registry, so they are created once per process.
+Metrics = namedtuple('Metrics', ['request_duration', 'request_queries', 'request_query_duration', 'operation_duration',
+                                 'task_duration', 'task_queue_wait', 'task_failures'])
+_metrics = None
+
+# Latency buckets in seconds, from cached lookups up to slow password hashes and directory calls.
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+# Background tasks range from sending one email to a full directory sync.
+TASK_BUCKETS = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+def init_metrics(app):
+    """Record request latency, per request SQL usage and password and LDAP timings, and serve them at /metrics.
+
+    prometheus_client keeps its values in per process memory mapped files when PROMETHEUS_MULTIPROC_DIR is set, which
+    is needed under uWSGI or gunicorn so that /metrics adds up every worker instead of whichever one answered."""
+    if not app.config.get('METRICS_TOKEN', False):
+        return
+    get_metrics()
+    listen_for_queries()
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        from prometheus_client import Counter, Histogram
+        _metrics = Metrics(
+            request_duration=Histogram('http_request_duration_seconds', 'Time spent handling a request',
+                                       ['endpoint', 'method', 'status'], buckets=DURATION_BUCKETS),
+            request_queries=Histogram('http_request_sql_queries', 'SQL queries run while handling a request',
+                                      ['endpoint'], buckets=QUERY_COUNT_BUCKETS),
+            request_query_duration=Histogram('http_request_sql_duration_seconds',
+                                             'Time spent in SQL queries while handling a request',
+                                             ['endpoint'], buckets=DURATION_BUCKETS),
+            operation_duration=Histogram('operation_duration_seconds', 'Time spent hashing passwords and calling LDAP',
+                                         ['operation'], buckets=DURATION_BUCKETS),
+            task_duration=Histogram('celery_task_duration_seconds', 'Time spent running a task',
+                                    ['task', 'state'], buckets=TASK_BUCKETS),
+            task_queue_wait=Histogram('celery_task_queue_wait_seconds', 'Time a task waited between being sent and run',
+                                      ['task'], buckets=TASK_BUCKETS),
+            task_failures=Counter('celery_task_failures', 'Tasks that raised an exception', ['task']),
+        )
+    return _metrics
+
+
+@contextmanager
+def track_duration(operation):
+    """Time the enclosed block as `operation`, for example 'password_verify' or 'ldap_search'"""
+    if _metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.operation_duration.labels(operation).observe(time.perf_counter() - start)
+
+
+def record_task(task_name, runtime, queue_wait=None, failed=False):
+    """Record one task run. Worker processes share /metrics with the web processes through PROMETHEUS_MULTIPROC_DIR"""
+    if _metrics is None:
+        return
+    _metrics.task_duration.labels(task_name, 'failure' if failed else 'success').observe(runtime)
+    if queue_wait is not None:
+        _metrics.task_queue_wait.labels(task_name).observe(max(queue_wait, 0))
+    if failed:
+        _metrics.task_failures.labels(task_name).inc()
+
+
+def listen_for_queries():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    # Listening on the Engine class covers every engine, including ones created after the app.
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    stats = request_cache('metrics')
+    if stats is not None and 'start' in stats:
+        stats['queries'] += 1
+        stats['query_time'] += elapsed
+
+
+def start_request_timer():
+    stats = request_cache('metrics')
+    stats.update(start=time.perf_counter(), queries=0, query_time=0.0)
+
+
+def record_request(response):
+    stats = request_cache('metrics')
+    if 'start' not in stats:
+        return response
+    # Unmatched URLs share one label so scanners cannot create unbounded series.
+    endpoint = request.endpoint or 'unmatched'
+    _metrics.request_duration.labels(endpoint, request.method, response.status_code).observe(
+        time.perf_counter() - stats['start'])
+    _metrics.request_queries.labels(endpoint).observe(stats['queries'])
+    _metrics.request_query_duration.labels(endpoint).observe(stats['query_time'])
+    return response
+
+
+def metrics_view():
+    authorization = request.headers.get('Authorization', '')
+    token = current_app.config['METRICS_TOKEN']
+    if not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer %s' % (token,)).encode('utf-8')):
+        abort(401)
+
+    from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
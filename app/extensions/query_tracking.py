@@ -0,0 +1,158 @@
+from collections import Counter
+from contextlib import ContextDecorator
+from flask import current_app, has_app_context, request
+import re
+import threading
+
+from app.utils.cache import request_cache
+
+# Recorders active on this thread. Every statement is counted by all of them, so budgets can be nested.
+_active = threading.local()
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number = re.compile(r'\b\d+(?:\.\d+)?\b')
+_named_parameter = re.compile(r'%\(\w+\)s|:\w+')
+_parameter_list = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_whitespace = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def normalize_statement(statement):
+    """Reduce a SQL statement to its shape, so the same query with different parameters compares equal"""
+    shape = _string_literal.sub('?', statement)
+    shape = _named_parameter.sub('?', shape)
+    shape = _number.sub('?', shape)
+    shape = _parameter_list.sub('(?...)', shape)
+    return _whitespace.sub(' ', shape).strip()
+
+
+class QueryRecorder(object):
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def record(self, statement):
+        self.statements.append(normalize_statement(statement))
+
+    def repeated(self, threshold=2):
+        """Return (shape, count) for every statement shape that ran at least `threshold` times, most frequent first"""
+        return [(shape, count) for shape, count in Counter(self.statements).most_common() if count >= threshold]
+
+    def start(self):
+        listen_for_queries()
+        stack = getattr(_active, 'recorders', None)
+        if stack is None:
+            stack = _active.recorders = []
+        stack.append(self)
+        return self
+
+    def stop(self):
+        stack = getattr(_active, 'recorders', [])
+        if self in stack:
+            stack.remove(self)
+
+
+class query_budget(ContextDecorator):
+    """Fail when the enclosed block or view function runs more than `max_queries` SQL statements.
+
+        @query_budget(10)
+        def user_admin_page():
+            ...
+
+        with query_budget(5):
+            client.get('/users')
+
+    Budgets are only enforced while query tracking is enabled, so in production they cost nothing."""
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        # A decorated view shares this instance between threads and may re-enter it.
+        self._local = threading.local()
+
+    def __enter__(self):
+        recorder = QueryRecorder()
+        self._local.__dict__.setdefault('recorders', []).append(recorder)
+        if tracking_enabled():
+            recorder.start()
+        return recorder
+
+    def __exit__(self, exc_type, exc, traceback):
+        recorder = self._local.recorders.pop()
+        recorder.stop()
+        if exc_type is None and recorder.count > self.max_queries:
+            raise QueryBudgetExceeded('%s SQL statements ran, the budget is %s.%s' % (
+                recorder.count, self.max_queries, describe_repeats(recorder)))
+        return False
+
+
+def tracking_enabled(app=None):
+    if app is None:
+        if not has_app_context():
+            return True
+        app = current_app
+    enabled = app.config.get('QUERY_TRACKING', None)
+    if enabled is None:
+        return app.debug or app.testing
+    return bool(enabled)
+
+
+def describe_repeats(recorder, threshold=2):
+    repeats = recorder.repeated(threshold)
+    if not repeats:
+        return ''
+    return ' Repeated statements:\n' + '\n'.join('%5d x %s' % (count, shape) for shape, count in repeats)
+
+
+def listen_for_queries():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    if not event.contains(Engine, 'before_cursor_execute', record_statement):
+        event.listen(Engine, 'before_cursor_execute', record_statement)
+
+
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    for recorder in getattr(_active, 'recorders', ()):
+        recorder.record(statement)
+
+
+def init_query_tracking(app):
+    """Record every request's SQL and log statement shapes that repeat, which usually means an N+1 query.
+
+    Enabled by QUERY_TRACKING, which defaults to on in debug and test mode. QUERY_BUDGET, when set, is enforced for
+    every request in addition to budgets declared with @query_budget."""
+    if not tracking_enabled(app):
+        return
+
+    threshold = app.config.get('QUERY_REPEAT_THRESHOLD', 5)
+    budget = app.config.get('QUERY_BUDGET', False)
+
+    @app.before_request
+    def start_recording():
+        request_cache('query_tracking')['recorder'] = QueryRecorder().start()
+
+    @app.after_request
+    def check_queries(response):
+        recorder = request_cache('query_tracking').get('recorder')
+        if recorder is None:
+            return response
+        recorder.stop()
+        for shape, count in recorder.repeated(threshold):
+            app.logger.warning('Possible N+1 query in %s: %d x %s', request.endpoint, count, shape)
+        if budget and recorder.count > budget:
+            raise QueryBudgetExceeded('%s ran %s SQL statements, the budget is %s.%s' % (
+                request.endpoint, recorder.count, budget, describe_repeats(recorder)))
+        return response
+
+    @app.teardown_request
+    def stop_recording(exc=None):
+        recorder = request_cache('query_tracking').get('recorder')
+        if recorder is not None:
+            recorder.stop()
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from flask import current_app, request
+from sqlalchemy import case, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import TooManyRequests
+import math
+import threading
+import time
+
+from app import db
+from app.extensions.database import replica_reads
+from app.models import user_models as users
+from app.utils.cache import TTLCache, request_cache
+
+
+class MemoryBuckets(object):
+    """Token buckets held in this process. Every process counts separately, so limits multiply with the workers."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """Take a token from bucket `key`, returning 0 on success or the seconds until one will be available"""
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1 if not wait else tokens, now)
+            # Forgetting the least recently used bucket only hands it a full refill.
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def refund(self, key, capacity):
+        """Return a token taken from bucket `key` to it"""
+        with self.lock:
+            if key in self.buckets:
+                tokens, updated_at = self.buckets[key]
+                self.buckets[key] = (min(capacity, tokens + 1), updated_at)
+
+
+class DatabaseBuckets(object):
+    """Token buckets in the rate_limit_buckets table, shared by every process and node.
+
+    A token is taken with a single conditional UPDATE that refills the bucket and decrements it, so concurrent requests
+    can not both spend the last token."""
+
+    def take(self, key, capacity, rate, now):
+        table = users.RateLimitBucket.__table__
+        refilled = table.c.tokens + (now - table.c.updated_at) * rate
+        available = case([(refilled > capacity, capacity)], else_=refilled)
+        take_token = table.update().where(table.c.key == key).where(available >= 1).values(
+            tokens=available - 1, updated_at=now)
+        with db.engine.connect() as connection:
+            if connection.execute(take_token).rowcount:
+                return 0
+            row = connection.execute(select([table.c.tokens, table.c.updated_at]).where(table.c.key == key)).first()
+            if row is None:
+                try:
+                    connection.execute(table.insert().values(key=key, tokens=capacity - 1, updated_at=now))
+                    return 0
+                except IntegrityError:
+                    # Another request created the bucket first.
+                    if connection.execute(take_token).rowcount:
+                        return 0
+                    row = connection.execute(
+                        select([table.c.tokens, table.c.updated_at]).where(table.c.key == key)).first()
+        tokens = min(capacity, row.tokens + (now - row.updated_at) * rate)
+        return max((1 - tokens) / rate, 0)
+
+    def refund(self, key, capacity):
+        table = users.RateLimitBucket.__table__
+        refunded = case([(table.c.tokens + 1 > capacity, capacity)], else_=table.c.tokens + 1)
+        with db.engine.connect() as connection:
+            connection.execute(table.update().where(table.c.key == key).values(tokens=refunded))
+
+
+def get_buckets():
+    if 'rate_limit_buckets' not in current_app.extensions:
+        backend = current_app.config.get('API_RATE_LIMIT_BACKEND', 'memory')
+        if backend == 'database':
+            buckets = DatabaseBuckets()
+        elif backend == 'memory':
+            buckets = MemoryBuckets()
+        else:
+            buckets = None
+        current_app.extensions['rate_limit_buckets'] = buckets
+    return current_app.extensions['rate_limit_buckets']
+
+
+def parse_limit(limit):
+    """Read a limit given as (requests, seconds) or 'requests/seconds', returning None when there is no limit"""
+    if not limit:
+        return None
+    if isinstance(limit, str):
+        limit = limit.split('/')
+    requests, seconds = limit
+    return int(requests), float(seconds)
+
+
+def get_limit_cache():
+    if 'api_rate_limit_cache' not in current_app.extensions:
+        current_app.extensions['api_rate_limit_cache'] = TTLCache(
+            maxsize=current_app.config.get('API_KEY_CACHE_SIZE', 1024),
+            ttl=current_app.config.get('API_KEY_CACHE_TTL', 300))
+    return current_app.extensions['api_rate_limit_cache']
+
+
+def get_key_limit(key_id):
+    """Return the most generous API_RATE_LIMITS entry among the roles of the key's owner, or None for unknown keys.
+
+    Owners without a listed role get the 'default' limit. Only ids and roles are read, nothing is hashed."""
+    cache = get_limit_cache()
+    limit = cache.get(key_id)
+    if limit is not None:
+        return limit
+
+    with replica_reads():
+        rows = db.session.query(users.ApiKey.id, users.Role.name) \
+            .outerjoin(users.UsersRoles, users.UsersRoles.user_id == users.ApiKey.user_id) \
+            .outerjoin(users.Role, users.Role.id == users.UsersRoles.role_id) \
+            .filter(users.ApiKey.id == key_id).all()
+    if not rows:
+        return None
+    limits = current_app.config.get('API_RATE_LIMITS', None) or {}
+    role_limits = [limits[name] for key, name in rows if name in limits] or [limits.get('default', False)]
+    parsed = [parse_limit(role_limit) for role_limit in role_limits]
+    limit = False if None in parsed else max(parsed, key=lambda item: item[0] / item[1])
+    cache.set(key_id, limit)
+    return limit
+
+
+def enforce_api_rate_limits():
+    """Abort with 429 once the client's IP address or the API_ID it presents has used up its requests.
+
+    Runs before any credential is verified, and counts each request once however many decorators call it."""
+    state = request_cache('rate_limit')
+    if state.get('checked'):
+        return
+    state['checked'] = True
+    buckets = get_buckets()
+    if buckets is None:
+        return
+
+    checks = [('ip:%s' % (request.remote_addr,), parse_limit(current_app.config.get('API_RATE_LIMIT_IP', False)))]
+    key_id = request.headers.get('API_ID')
+    if not key_id:
+        # Bearer tokens only take an HMAC check to read, which is cheap enough to come before the limit.
+        from app.utils.api import load_api_token
+        token = load_api_token()
+        key_id = token['k'] if token else None
+    if key_id:
+        checks.append(('key:%s' % (key_id,), get_key_limit(key_id)))
+    now = time.time()
+    taken = []
+    for key, limit in checks:
+        if not limit:
+            continue
+        requests, seconds = limit
+        wait = buckets.take(key, requests, requests / seconds, now)
+        if wait:
+            # A refused request should not count against the limits that allowed it.
+            for taken_key, capacity in taken:
+                buckets.refund(taken_key, capacity)
+            retry_after = max(int(math.ceil(wait)), 1)
+            raise TooManyRequests('Rate limit exceeded, retry in %d seconds.' % (retry_after,), retry_after=retry_after)
+        taken.append((key, requests))
+
+
+def purge_idle_buckets(batch_size=1000):
+    """Delete database buckets idle long enough to have refilled, which behave exactly like missing ones"""
+    limits = [parse_limit(current_app.config.get('API_RATE_LIMIT_IP', False))]
+    limits += [parse_limit(limit) for limit in (current_app.config.get('API_RATE_LIMITS', None) or {}).values()]
+    cutoff = time.time() - max([seconds for requests, seconds in filter(None, limits)] or [0])
+    table = users.RateLimitBucket.__table__
+    removed = 0
+    while True:
+        with db.engine.begin() as connection:
+            idle = select([table.c.key]).where(table.c.updated_at < cutoff).limit(batch_size)
+            keys = [row.key for row in connection.execute(idle)]
+            if keys:
+                connection.execute(table.delete().where(table.c.key.in_(keys)))
+        removed += len(keys)
+        if len(keys) < batch_size:
+            return removed
@@ -0,0 +1,209 @@
+from datetime import datetime, timedelta
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import select
+from werkzeug.datastructures import CallbackDict
+import hashlib
+import pickle
+import secrets
+import time
+import zlib
+
+from app import db
+from app.models.user_models import UserSession
+
+# Beaker sets these itself, on every load or for every new session, so they say nothing about whether the session
+# itself changed.
+VOLATILE_KEYS = ('_accessed_time', '_creation_time', '_domain', '_path')
+
+
+def get_session_digest(session):
+    items = sorted((key, value) for key, value in session.items() if key not in VOLATILE_KEYS)
+    return hashlib.sha1(pickle.dumps(items, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+EMPTY_DIGEST = hashlib.sha1(pickle.dumps([], pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+session_serializer = TaggedJSONSerializer()
+
+# Serialized sessions larger than this many bytes are stored zlib compressed.
+COMPRESS_THRESHOLD = 512
+
+
+class BeakerSessionInterface(SessionInterface):
+    """Hands Flask the Beaker session and only asks Beaker to write it back when it has changed.
+
+    Changes are found by comparing a digest of the session taken when it was opened with one taken when the response
+    is sent, which also catches in place mutations such as `session['_flashes'].append()`. Sessions that did not change
+    are still written once every `refresh_interval` seconds so their cookie and server side expiry keep moving."""
+
+    def __init__(self, cookie_key='beaker.session.id', refresh_interval=3600):
+        self.cookie_key = cookie_key
+        self.refresh_interval = refresh_interval
+
+    def open_session(self, app, request):
+        session = request.environ['beaker.session']
+        # Requests without a session cookie start out empty, so there is no need to load anything to know that.
+        if self.cookie_key in request.cookies:
+            session.__dict__['_open_digest'] = get_session_digest(session)
+        else:
+            session.__dict__['_open_digest'] = EMPTY_DIGEST
+        return session
+
+    def save_session(self, app, session, response):
+        if not session.accessed() or session.dirty():
+            return
+        if get_session_digest(session) != session.__dict__.get('_open_digest'):
+            session.save()
+        elif not session.is_new and self.needs_refresh(session):
+            session.save()
+
+    def needs_refresh(self, session):
+        return session.last_accessed is None or time.time() - session.last_accessed >= self.refresh_interval
+
+
+class CookieSessionInterface(SecureCookieSessionInterface):
+    """Keeps the whole session in a signed cookie, which removes server side session storage entirely.
+
+    The cookie is readable by the client and browsers cap it at about 4KB, so only use it for small sessions that hold
+    nothing secret. Permanent sessions follow `permanent_session_lifetime`, the rest expire after `cookie_expires`."""
+
+    def __init__(self, cookie_expires=86400):
+        self.cookie_expires = cookie_expires
+
+    def get_expiration_time(self, app, session):
+        if session.permanent:
+            return super(CookieSessionInterface, self).get_expiration_time(app, session)
+        if not self.cookie_expires:
+            return None
+        return datetime.utcnow() + timedelta(seconds=self.cookie_expires)
+
+
+def dump_session_data(data):
+    """Serialize a session as compact tagged JSON, compressing it when that is worth it"""
+    payload = session_serializer.dumps(dict(data)).encode('utf-8')
+    if len(payload) > COMPRESS_THRESHOLD:
+        return b'z' + zlib.compress(payload)
+    return b'j' + payload
+
+
+def load_session_data(data):
+    payload = zlib.decompress(data[1:]) if data[:1] == b'z' else data[1:]
+    return session_serializer.loads(payload.decode('utf-8'))
+
+
+class DatabaseSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False, stored=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.stored = stored
+        self.expires_at = expires_at
+        self.modified = False
+
+
+class DatabaseSessionInterface(SessionInterface):
+    """Stores sessions in the `sessions` table so that any app node can serve any request.
+
+    The cookie only carries a signed random session id. A row is only written when the serialized session changed, or
+    once `refresh_interval` seconds of its lifetime have passed, and expired rows are removed by purge_expired_sessions().
+    Rows are read and written on their own connection so they never commit the request's pending ORM changes."""
+
+    session_class = DatabaseSession
+    salt = 'database-session'
+
+    def __init__(self, cookie_expires=86400, refresh_interval=3600):
+        self.cookie_expires = cookie_expires
+        self.refresh_interval = refresh_interval
+
+    def get_signer(self, app):
+        if not app.secret_key:
+            return None
+        return Signer(app.secret_key, salt=self.salt, key_derivation='hmac', digest_method=hashlib.sha256)
+
+    def get_lifetime(self, app, session):
+        if session.permanent:
+            return app.permanent_session_lifetime
+        return timedelta(seconds=self.cookie_expires or 86400)
+
+    def open_session(self, app, request):
+        signer = self.get_signer(app)
+        if signer is None:
+            return None
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie:
+            try:
+                sid = signer.unsign(cookie).decode('ascii')
+            except BadSignature:
+                sid = None
+            row = load_session(sid) if sid else None
+            if row is not None:
+                return self.session_class(load_session_data(row.data), sid=sid, stored=row.data,
+                                          expires_at=row.expires_at)
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.stored is not None:
+                delete_session(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        data = dump_session_data(session)
+        now = datetime.utcnow()
+        lifetime = self.get_lifetime(app, session)
+        # Refresh at least halfway through the lifetime, so an active session never expires between writes.
+        refresh = min(timedelta(seconds=self.refresh_interval), lifetime / 2)
+        if data == session.stored and session.expires_at - now > lifetime - refresh:
+            return
+
+        expires_at = now + lifetime
+        store_session(session.sid, data, expires_at)
+        response.set_cookie(app.session_cookie_name, self.get_signer(app).sign(session.sid).decode('ascii'),
+                            expires=expires_at, httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def load_session(sid):
+    table = UserSession.__table__
+    query = select([table.c.data, table.c.expires_at]).where(table.c.id == sid)
+    with db.engine.connect() as connection:
+        row = connection.execute(query.where(table.c.expires_at > datetime.utcnow())).first()
+    return row
+
+
+def store_session(sid, data, expires_at):
+    table = UserSession.__table__
+    with db.engine.begin() as connection:
+        result = connection.execute(table.update().where(table.c.id == sid).values(data=data, expires_at=expires_at))
+        if not result.rowcount:
+            connection.execute(table.insert().values(id=sid, data=data, expires_at=expires_at))
+
+
+def delete_session(sid):
+    table = UserSession.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.delete().where(table.c.id == sid))
+
+
+def purge_expired_sessions(batch_size=1000):
+    """Delete expired sessions one batch per transaction, so cleanup never holds locks on much of the table"""
+    table = UserSession.__table__
+    removed = 0
+    while True:
+        with db.engine.begin() as connection:
+            expired = select([table.c.id]).where(table.c.expires_at <= datetime.utcnow()).limit(batch_size)
+            ids = [row.id for row in connection.execute(expired)]
+            if ids:
+                connection.execute(table.delete().where(table.c.id.in_(ids)))
+        removed += len(ids)
+        if len(ids) < batch_size:
+            return removed
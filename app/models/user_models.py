@@ -8,7 +8,9 @@ from flask_user.forms import RegisterForm
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, validators, PasswordField, BooleanField
 from app import db
+from app.utils.cache import request_cache
 from app.utils.forms import MultiCheckboxField
+from app.utils.permissions import Permissions
 from app.extensions import ldap
 
 
@@ -32,31 +34,7 @@ class TedivmUserMixin(UserMixin):
             Translates to:
                 User has role 'a' AND (role 'b' OR role 'c') AND role 'd'"""
 
-        # Translates a list of role objects to a list of role_names
-        user_manager = current_app.user_manager
-
-        # has_role() accepts a list of requirements
-        for requirement in requirements:
-            if isinstance(requirement, (list, tuple)):
-                # this is a tuple_of_role_names requirement
-                tuple_of_role_names = requirement
-                authorized = False
-                for role_name in tuple_of_role_names:
-                    if self.has_role(role_name):
-                        # tuple_of_role_names requirement was met: break out of loop
-                        authorized = True
-                        break
-                if not authorized:
-                    return False                    # tuple_of_role_names requirement failed: return False
-            else:
-                # this is a role_name requirement
-                role_name = requirement
-                # the user must have this role
-                if self.has_role(role_name):
-                    return False                    # role_name requirement failed: return False
-
-        # All requirements have been met: return True
-        return True
+        return self.permissions.has_roles(*requirements)
 
 
 
@@ -83,20 +61,30 @@ class User(db.Model, TedivmUserMixin):
     # API Keys
     apikeys = db.relationship('ApiKey', backref='user')
 
-    def has_role(self, role, allow_admin=True):
-
-        if current_app.config.get('USER_LDAP', False):
-            group = current_app.config.get('LDAP_GROUP_TO_ROLE_%s' % role.upper(), False)
-            if not group:
-                return False
-            return ldap.user_in_group(self.username, group)
+    @property
+    def permissions(self):
+        """The user's roles as an immutable Permissions object, loaded at most once per request"""
+        loaded = request_cache('user_permissions')
+        if loaded is None:
+            return self.load_permissions()
+        if self.id not in loaded:
+            loaded[self.id] = self.load_permissions()
+        return loaded[self.id]
+
+    def load_permissions(self):
+        if current_app.config.get('USER_LDAP', False) and not current_app.config.get('LDAP_ROLES_FROM_DATABASE', False):
+            groups = ldap.get_user_groups(self.username)
+            return Permissions(role for role, group in ldap.get_role_groups().items() if group in groups)
+
+        # Reuse the relationship if it was already loaded, otherwise fetch only the role names.
+        if 'roles' in self.__dict__ or self.id is None:
+            return Permissions(item.name for item in self.roles)
+        return Permissions(name for (name,) in db.session.query(Role.name)
+                           .join(UsersRoles, UsersRoles.role_id == Role.id)
+                           .filter(UsersRoles.user_id == self.id))
 
-        for item in self.roles:
-            if item.name == role:
-                return True
-            if allow_admin and item.name == 'admin':
-                return True
-        return False
+    def has_role(self, role, allow_admin=True):
+        return self.permissions.has_role(role, allow_admin)
 
     def role(self):
         for item in self.roles:
@@ -113,6 +101,7 @@ class ApiKey(db.Model):
     hash = db.Column(db.Unicode(255), nullable=False)
     label = db.Column(db.Unicode(255), nullable=True)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'))
+    epoch = db.Column(db.Integer(), nullable=False, server_default='0', default=0)  # Raised to revoke issued tokens
 
 
 # Define the Role data model
@@ -123,6 +112,28 @@ class Role(db.Model):
     label = db.Column(db.Unicode(255), server_default=u'')  # for display purposes
 
 
+# Tracks how far the background LDAP directory sync has progressed
+class LdapSyncState(db.Model):
+    __tablename__ = 'ldap_sync_state'
+    name = db.Column(db.String(50), primary_key=True)
+    last_modified = db.Column(db.String(32), nullable=True)  # Newest modifyTimestamp seen, in generalizedTime
+    synced_at = db.Column(db.DateTime())
+
+
+class UserSession(db.Model):
+    __tablename__ = 'sessions'
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary(), nullable=False)  # Serialized by app.extensions.sessions
+    expires_at = db.Column(db.DateTime(), nullable=False, index=True)
+
+
+class RateLimitBucket(db.Model):
+    __tablename__ = 'rate_limit_buckets'
+    key = db.Column(db.String(128), primary_key=True)
+    tokens = db.Column(db.Float(), nullable=False)  # Tokens left at updated_at, see app.extensions.rate_limit
+    updated_at = db.Column(db.Float(), nullable=False, index=True)  # Unix time of the last refill
+
+
 # Define the UserRoles association model
 class UsersRoles(db.Model):
     __tablename__ = 'users_roles'
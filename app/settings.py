@@ -13,9 +13,21 @@ APP_OWNER_NAME = "Change this in settings."
 CSRF_ENABLED = True
 SECRET_KEY = None
 
+# Configuration snapshots. Settings loaded from AWS Secrets Manager are cached in this file so that new
+# processes can start without a remote call. The file holds secrets, so keep it on a private volume.
+CONFIG_SNAPSHOT_PATH = False
+CONFIG_SNAPSHOT_TTL = 300  # Seconds a snapshot is used as is. Up to twice this it is used while refreshing.
+CONFIG_SNAPSHOT_KEY = False  # Optional key to sign snapshots with instead of a plain checksum
+
 # Flask-SQLAlchemy settings
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_DATABASE_URI = 'sqlite:///app.sqlite'
+SQLALCHEMY_REPLICA_URIS = []  # Read replicas for views marked with use_replica, as a list or comma separated string
+SQLALCHEMY_REPLICA_STICKY_SECONDS = 5  # Seconds a browser reads from the primary after one of its requests wrote
+DATABASE_POOL_SIZE = 5  # Connections kept open per process (not used with SQLite)
+DATABASE_MAX_OVERFLOW = 10  # Extra connections allowed above the pool size under load (not used with SQLite)
+DATABASE_POOL_PRE_PING = True  # Test connections when they are checked out, replacing ones the server closed
+DATABASE_POOL_RECYCLE = 1800  # Seconds before a connection is replaced, keep below the server's idle timeout
 
 # Celery Configuration
 CELERY_BROKER = False
@@ -25,7 +37,40 @@ CELERY_RESULTS = False
 CACHE_TYPE = False
 CACHE_ROOT = False
 CACHE_URL = False
+CACHE_EXPIRE = 3600  # Default seconds before cached values expire
+CACHE_REGIONS = {'api_key_epochs': 60}  # Per region expiry in seconds. On per-host backends api_key_epochs bounds revocation delay
+CACHE_LOCAL_SIZE = 1000  # Values kept in each region's in-process LRU tier
+CACHE_LOCAL_TTL = 30  # Seconds a value may be served from the in-process tier
+CACHE_SWEEP_INTERVAL = 3600  # Seconds between worker sweeps of expired session, cache and lock files under CACHE_ROOT
+CACHE_SWEEP_BATCH_SIZE = 500  # Files deleted between pauses while sweeping
+CACHE_SWEEP_PAUSE = 0.05  # Seconds to pause after each batch of deleted files
+
+# Sessions
+SESSION_BACKEND = 'beaker'  # 'beaker' uses the cache backend, 'database' the shared sessions table, 'cookie' a signed cookie
+SESSION_AUTO = False  # Write Beaker sessions on every request, even when they did not change
+SESSION_REFRESH_INTERVAL = 3600  # Seconds before an unchanged session is written again to extend its expiry
+SESSION_PURGE_INTERVAL = 3600  # Seconds between removals of expired database sessions by the worker
+SESSION_PURGE_BATCH_SIZE = 1000  # Expired database sessions deleted per transaction
+SESSION_COOKIE_EXPIRES = 86400  # Seconds before the session cookie expires
+
+# Metrics
+METRICS_TOKEN = False  # Bearer token required to read /metrics, which is disabled while this is unset
+QUERY_TRACKING = None  # Record SQL per request to flag N+1 queries and enforce query budgets, on in debug and test mode
+QUERY_REPEAT_THRESHOLD = 5  # Log a possible N+1 query when one statement shape runs this often in a request
+QUERY_BUDGET = False  # Fail any request that runs more SQL statements than this while query tracking is on
+
+# API Keys
+API_KEY_SECRET = False  # Secret used to hash API keys, defaults to SECRET_KEY. Rotating it invalidates existing keys.
+API_KEY_CACHE_SIZE = 1024  # Number of verified API credentials to remember per process
+API_KEY_CACHE_TTL = 300  # Seconds before a verified API credential has to be checked again
+API_TOKEN_TTL = 300  # Seconds a bearer token from /api/token stays valid
 
+# API Rate Limits, given as (requests, seconds). Requests over a limit get a 429 response with Retry-After.
+API_RATE_LIMIT_BACKEND = 'memory'  # 'memory' is per process. 'database' is shared by all nodes but writes to the primary on every API request
+API_RATE_LIMIT_IP = (300, 60)  # Limit for each client IP address
+API_RATE_LIMITS = {'default': (60, 60), 'admin': (600, 60)}  # Limit for each API key by its owner's roles, False for none
+API_RATE_LIMIT_PURGE_INTERVAL = 3600  # Seconds between removals of idle database buckets by the worker
+API_RATE_LIMIT_PURGE_BATCH_SIZE = 1000  # Idle database buckets deleted per transaction
 
 
 # Flask-User settings
@@ -41,6 +86,8 @@ USER_ENABLE_USERNAME = False  # Register and Login with username
 USER_AFTER_LOGIN_ENDPOINT = 'main.member_page'
 USER_AFTER_LOGOUT_ENDPOINT = 'main.member_page'
 USER_ALLOW_LOGIN_WITHOUT_CONFIRMED_EMAIL = False
+USER_ADMIN_PAGE_SIZE = 50  # Users listed per page on the user administration page
+PASSWORD_HASH_ROUNDS = False  # bcrypt cost factor, see "manage.py benchmark-password-hash". False uses passlib's default.
 
 
 USER_LDAP = False
@@ -57,6 +104,17 @@ LDAP_GROUP_TO_ROLE_ADMIN=False
 LDAP_GROUP_TO_ROLE_DEV=False
 LDAP_GROUP_TO_ROLE_USER=False
 LDAP_EMAIL_ATTRIBUTE=False
+LDAP_GROUP_CACHE_SIZE = 1024  # Number of users whose group memberships are kept per process
+LDAP_GROUP_CACHE_TTL = 300  # Seconds before a user's group memberships are fetched again
+LDAP_POOL_SIZE = 10  # Idle service account connections kept open per process
+LDAP_POOL_IDLE_TIMEOUT = 300  # Seconds an idle connection is trusted before it is replaced
+LDAP_CONNECT_TIMEOUT = 5
+LDAP_RECEIVE_TIMEOUT = 10
+LDAP_SERVER_INFO = False  # Set to SCHEMA, DSA or ALL to have ldap3 read server info when connecting
+LDAP_ROLES_FROM_DATABASE = False  # Answer role checks from the local tables kept current by the directory sync
+LDAP_SYNC_INTERVAL = False  # Seconds between incremental directory syncs scheduled with celery beat
+LDAP_SYNC_FULL_INTERVAL = False  # Seconds between full syncs, which also deactivate users removed from LDAP
+LDAP_SYNC_PAGE_SIZE = 500
 
 
 # Flask-Mail settings
@@ -69,6 +127,15 @@ MAIL_USE_TLS = True
 MAIL_USERNAME = 'you@gmail.com'
 MAIL_PASSWORD = 'yourpassword'
 MAIL_DEFAULT_SENDER = '"You" <you@gmail.com>'
+MAIL_BATCH_SIZE = 50  # Queued emails a worker sends per task over one SMTP connection
+MAIL_FLUSH_INTERVAL = 1  # Seconds queued emails wait so they can be sent together
+MAIL_DRAIN_INTERVAL = 60  # Seconds between scheduled sends of queued emails, in case no send was triggered
+MAIL_MAX_ATTEMPTS = 5  # Times a queued email is tried before it is logged and dropped
+MAIL_CONNECTION_IDLE_TIMEOUT = 60  # Seconds an idle SMTP connection is kept open for the next batch
 ADMINS = [
     '"Admin One" <admin1@gmail.com>',
     ]
+ERROR_EMAIL_WINDOW = 60  # Seconds errors are collected before they are emailed to ADMINS as one summary
+ERROR_EMAIL_MAX_PER_HOUR = 12  # Error summaries sent per hour, later errors are counted in the next allowed summary
+ERROR_EMAIL_MAX_GROUPS = 20  # Kinds of error described in one summary, others are only counted
+ERROR_EMAIL_QUEUE_SIZE = 1000  # Errors waiting for the background sender before new ones are dropped
@@ -0,0 +1,4 @@
+# __init__.py is a special Python file that allows a directory to become
+# a Python package so it can be accessed using the 'import' statement.
+
+# Celery tasks live in this package. Import new task modules in app/worker.py.
@@ -0,0 +1,183 @@
+from celery import Task
+from celery.exceptions import Retry
+from celery.signals import worker_process_init
+from datetime import datetime
+from flask import current_app, has_app_context
+from functools import update_wrapper
+import time
+
+from app import celery, db
+from app.extensions.metrics import record_task
+
+# The Flask application tasks run in. Bound once per process by init_celery_service() instead of per task.
+_app = None
+
+
+def bind_app(app):
+    global _app
+    _app = app
+
+
+def get_app():
+    global _app
+    if _app is None:
+        if has_app_context():
+            return current_app._get_current_object()
+        from app import create_app
+        _app = create_app()
+    return _app
+
+
+@worker_process_init.connect
+def reset_connections(**kwargs):
+    """Pool processes are forked from the worker, so drop any database connections they inherited from it"""
+    if _app is None:
+        return
+    with _app.app_context():
+        db.session.remove()
+        for bind in [None] + _app.extensions.get('database_replicas', []):
+            db.get_engine(_app, bind=bind).dispose()
+
+
+class AppTask(Task):
+    """Base class of every task. Runs each task in an application context with its own SQLAlchemy session and records
+    its runtime, queue wait and failures.
+
+    Tasks called directly or eagerly from code that already has an application context share that context and its
+    session, so they see the caller's uncommitted changes and leave its session open."""
+
+    def __call__(self, *args, **kwargs):
+        if has_app_context() and (self.request.called_directly or self.request.is_eager):
+            return super(AppTask, self).__call__(*args, **kwargs)
+
+        queue_wait = self.get_queue_wait()
+        start = time.perf_counter()
+        failed = False
+        with get_app().app_context():
+            try:
+                return super(AppTask, self).__call__(*args, **kwargs)
+            except Retry:
+                raise
+            except Exception:
+                failed = True
+                raise
+            finally:
+                db.session.remove()
+                record_task(self.name, time.perf_counter() - start, queue_wait, failed)
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        # Stamp the time the task may start, so the worker can tell how long it sat in the queue.
+        headers = dict(options.pop('headers', None) or {})
+        headers.setdefault('runnable_at', runnable_at(options.get('countdown'), options.get('eta')))
+        return super(AppTask, self).apply_async(args, kwargs, headers=headers, **options)
+
+    def get_queue_wait(self):
+        # Celery copies custom headers onto the request, older protocols and eager calls keep them in `headers`.
+        stamp = getattr(self.request, 'runnable_at', None) or (self.request.headers or {}).get('runnable_at')
+        if stamp is None:
+            return None
+        return time.time() - float(stamp)
+
+
+def runnable_at(countdown=None, eta=None):
+    if eta is not None:
+        return eta.timestamp() if isinstance(eta, datetime) else float(eta)
+    return time.time() + float(countdown or 0)
+
+
+def batched_task(name, batch_size=100, flush_interval=1.0, max_attempts=5, retry_delay=30):
+    """Turn a function that handles a list of jobs into a task that collects small jobs and runs them together.
+
+        @batched_task('app.tasks.mail.send_messages', batch_size=50)
+        def send_messages(messages):
+            ...
+
+        send_messages.enqueue({'to': 'someone@example.com'})
+
+    Jobs must be JSON serializable. The function may return the positions of jobs that failed, which are retried
+    without repeating the others. Without a broker, or with task_always_eager, jobs are handled immediately, one at
+    a time."""
+    def decorator(handler):
+        return BatchedTask(handler, name, batch_size, flush_interval, max_attempts, retry_delay)
+    return decorator
+
+
+class BatchedTask(object):
+    """Jobs wait on their own broker queue until a `name` task drains up to `batch_size` of them into one handler call.
+
+    A drain is scheduled `flush_interval` seconds after a job is enqueued, at most once per interval in each process,
+    and reschedules itself while jobs are left. Jobs can be left waiting when a scheduled drain is lost, so the `name`
+    task should also be run periodically from the beat schedule.
+
+    Jobs the handler reports as failed, or every job of a batch when the handler raises, go to the back of the queue
+    and are tried again by a drain `retry_delay` seconds later. A job that failed `max_attempts` times is logged and
+    dropped, so it can not hold up the jobs behind it forever."""
+
+    def __init__(self, handler, name, batch_size, flush_interval, max_attempts=5, retry_delay=30):
+        update_wrapper(self, handler)
+        self.handler = handler
+        self.queue_name = 'batch.%s' % (name,)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._next_drain = 0
+
+        @celery.task(name=name)
+        def drain():
+            return self.drain_queue()
+        self.drain = drain
+
+    def __call__(self, jobs):
+        return self.handler(jobs)
+
+    def enqueue(self, job):
+        if not get_app().config.get('CELERY_BROKER', False) or celery.conf.task_always_eager:
+            return self.handler([job])
+        with celery.connection_or_acquire() as connection:
+            with connection.SimpleQueue(self.queue_name) as queue:
+                queue.put(job, serializer='json')
+        self.schedule_drain()
+
+    def schedule_drain(self):
+        now = time.time()
+        if now < self._next_drain:
+            return
+        self._next_drain = now + self.flush_interval
+        self.drain.apply_async(countdown=self.flush_interval)
+
+    def drain_queue(self):
+        messages = []
+        with celery.connection_or_acquire() as connection:
+            with connection.SimpleQueue(self.queue_name) as queue:
+                while len(messages) < self.batch_size:
+                    try:
+                        messages.append(queue.get(block=False))
+                    except queue.Empty:
+                        break
+                if not messages:
+                    return 0
+                try:
+                    failed = set(self.handler([message.payload for message in messages]) or ())
+                except Exception:
+                    self.retry_jobs(queue, messages)
+                    raise
+                for position, message in enumerate(messages):
+                    if position not in failed:
+                        message.ack()
+                self.retry_jobs(queue, [messages[position] for position in sorted(failed)])
+                remaining = queue.qsize()
+        if remaining:
+            # Give failing jobs time to recover instead of retrying them straight away.
+            self.drain.apply_async(countdown=self.retry_delay if failed else None)
+        return len(messages) - len(failed)
+
+    def retry_jobs(self, queue, messages):
+        for message in messages:
+            attempts = (message.headers or {}).get('batch_attempts', 1)
+            if attempts >= self.max_attempts:
+                current_app.logger.error('Dropped %s job after %d attempts: %r', self.queue_name, attempts,
+                                         message.payload)
+            else:
+                queue.put(message.payload, serializer='json', headers={'batch_attempts': attempts + 1})
+            message.ack()
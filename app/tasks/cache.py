@@ -0,0 +1,11 @@
+from flask import current_app
+
+from app import celery
+from app.extensions.cache_sweeper import sweep_cache_root
+
+
+@celery.task(name='app.tasks.cache.sweep_cache_files')
+def sweep_cache_files():
+    """Delete expired Beaker session, cache and lock files under CACHE_ROOT"""
+    return sweep_cache_root(batch_size=current_app.config.get('CACHE_SWEEP_BATCH_SIZE', 500),
+                            pause=current_app.config.get('CACHE_SWEEP_PAUSE', 0.05))
@@ -0,0 +1,8 @@
+from app import celery
+from app.extensions.ldap_sync import sync_directory
+
+
+@celery.task(name='app.tasks.ldap.sync_ldap_directory')
+def sync_ldap_directory(full=False):
+    """Mirror the LDAP directory into the local user and role tables"""
+    return sync_directory(full=full)
@@ -0,0 +1,27 @@
+from flask import current_app
+import smtplib
+
+from app import base_config
+from app.extensions.mail import deliver, message_from_dict
+from app.tasks.base import batched_task
+
+
+@batched_task('app.tasks.mail.send_messages', batch_size=base_config.get('MAIL_BATCH_SIZE', 50),
+              flush_interval=base_config.get('MAIL_FLUSH_INTERVAL', 1),
+              max_attempts=base_config.get('MAIL_MAX_ATTEMPTS', 5))
+def send_messages(messages):
+    """Send queued email messages over the worker's SMTP connection, returning the positions of those that failed.
+
+    Messages already sent are never retried along with a failed one. When the server can not be reached at all the
+    rest of the batch is left for a later attempt."""
+    failed = []
+    for position, message in enumerate(messages):
+        try:
+            deliver([message_from_dict(message)])
+        except smtplib.SMTPException as e:
+            current_app.logger.warning('Failed to send email %r: %s', message.get('subject'), e)
+            failed.append(position)
+        except OSError as e:
+            current_app.logger.warning('Failed to connect to the mail server: %s', e)
+            return failed + list(range(position, len(messages)))
+    return failed
@@ -0,0 +1,10 @@
+from flask import current_app
+
+from app import celery
+from app.extensions.rate_limit import purge_idle_buckets
+
+
+@celery.task(name='app.tasks.rate_limit.purge_rate_limit_buckets')
+def purge_rate_limit_buckets():
+    """Remove API rate limit buckets that have been idle long enough to refill"""
+    return purge_idle_buckets(batch_size=current_app.config.get('API_RATE_LIMIT_PURGE_BATCH_SIZE', 1000))
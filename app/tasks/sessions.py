@@ -0,0 +1,10 @@
+from flask import current_app
+
+from app import celery
+from app.extensions.sessions import purge_expired_sessions as purge_sessions
+
+
+@celery.task(name='app.tasks.sessions.purge_expired_sessions')
+def purge_expired_sessions():
+    """Remove expired rows from the database session store"""
+    return purge_sessions(batch_size=current_app.config.get('SESSION_PURGE_BATCH_SIZE', 1000))
@@ -1,33 +1,169 @@
+from app import cache, db
+from app.extensions.database import replica_reads
+from app.extensions.rate_limit import enforce_api_rate_limits
 from app.models import user_models as users
+from app.utils.cache import TTLCache, request_cache
+from app.utils.permissions import Permissions
 from functools import wraps
 from flask import request, abort, current_app
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+import hashlib
+import hmac
 
+# Prefix marking ApiKey.hash values produced by hash_api_key(). Anything else is a legacy password hash.
+API_KEY_HASH_PREFIX = 'v1$'
 
-def is_authorized_api_user(roles=False):
-    """Verify API Token and its owners permission to use it"""
-    if 'API_ID' not in request.headers:
+
+def get_verified_key_cache():
+    """Return the per-process cache of API credentials that have already passed verification, with their key's epoch"""
+    if 'api_key_cache' not in current_app.extensions:
+        current_app.extensions['api_key_cache'] = TTLCache(
+            maxsize=current_app.config.get('API_KEY_CACHE_SIZE', 1024),
+            ttl=current_app.config.get('API_KEY_CACHE_TTL', 300))
+    return current_app.extensions['api_key_cache']
+
+
+def get_credential_digest(api_key):
+    """Keyed digest of an API key, so neither the cache nor the database holds the raw secret"""
+    secret = current_app.config.get('API_KEY_SECRET') or current_app.secret_key or ''
+    return hmac.new(secret.encode('utf-8'), api_key.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def hash_api_key(key):
+    """Hash a newly generated API key for storage in ApiKey.hash.
+
+    API keys are random 128 bit values, so a keyed fast digest is as safe as a slow password hash while costing
+    microseconds instead of the tens of milliseconds bcrypt is tuned for."""
+    return API_KEY_HASH_PREFIX + get_credential_digest(key)
+
+
+def verify_api_key(api_key, key):
+    """Check a presented key against an ApiKey row, upgrading legacy password hashes on success"""
+    if api_key.hash.startswith(API_KEY_HASH_PREFIX):
+        return hmac.compare_digest(api_key.hash, hash_api_key(key))
+    if not current_app.user_manager.verify_password(key, api_key.hash):
         return False
+    api_key.hash = hash_api_key(key)
+    db.session.commit()
+    return True
+
+
+def invalidate_api_key(key_id):
+    """Drop any cached verification for the given API key id, and with it the key's epoch"""
+    get_verified_key_cache().delete_matching(lambda cache_key: cache_key[0] == key_id)
+    get_api_key_epoch.invalidate(key_id)
+
+
+@cache.memoize('api_key_epochs', key=lambda key_id: key_id)
+def get_api_key_epoch(key_id):
+    """Current revocation epoch of an API key, or None once the key has been deleted"""
+    return db.session.query(users.ApiKey.epoch).filter(users.ApiKey.id == key_id).scalar()
+
+
+def revoke_api_tokens(*user_ids, chunk_size=500):
+    """Invalidate every token issued from the users' API keys, for example after their roles changed"""
+    user_ids = list(user_ids)
+    key_ids = []
+    for offset in range(0, len(user_ids), chunk_size):
+        key_ids += [key_id for key_id, in db.session.query(users.ApiKey.id)
+                    .filter(users.ApiKey.user_id.in_(user_ids[offset:offset + chunk_size]))]
+    if not key_ids:
+        return
+    for offset in range(0, len(key_ids), chunk_size):
+        users.ApiKey.query.filter(users.ApiKey.id.in_(key_ids[offset:offset + chunk_size])).update(
+            {users.ApiKey.epoch: users.ApiKey.epoch + 1}, synchronize_session=False)
+    db.session.commit()
+    for key_id in key_ids:
+        get_api_key_epoch.invalidate(key_id)
+
+
+def get_token_serializer():
+    secret = current_app.config.get('API_KEY_SECRET') or current_app.secret_key or ''
+    return URLSafeTimedSerializer(secret, salt='api-token', signer_kwargs={'digest_method': hashlib.sha256})
+
+
+def create_api_token(api_key):
+    """Sign a token for the key's owner, carrying their roles so requests using it need no database lookups"""
+    user = users.User.query.get(api_key.user_id)
+    payload = {'k': api_key.id, 'e': api_key.epoch, 'u': user.id, 'r': sorted(user.permissions.roles)}
+    return get_token_serializer().dumps(payload)
+
+
+def load_api_token():
+    """Return the verified payload of the bearer token sent with this request, or None.
+
+    Only the signature, age and the key's epoch are checked. The epoch comes from the 'api_key_epochs' cache region,
+    so deleting a key or revoking its tokens reaches processes sharing the cache backend within CACHE_LOCAL_TTL
+    seconds, and other hosts once the region's entry expires."""
+    state = request_cache('api_token')
+    if 'payload' in state:
+        return state['payload']
+    state['payload'] = None
+    authorization = request.headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    try:
+        payload = get_token_serializer().loads(authorization[len('Bearer '):].strip(),
+                                               max_age=current_app.config.get('API_TOKEN_TTL', 300))
+    except BadSignature:
+        return None
+    if not isinstance(payload, dict) or get_api_key_epoch(payload.get('k')) != payload.get('e'):
+        return None
+    state['payload'] = payload
+    return payload
+
+
+def verify_api_credentials():
+    """Return the id of the user owning the API credentials in the request headers, or None"""
+    if 'API_ID' not in request.headers:
+        return None
     if 'API_KEY' not in request.headers:
-        return False
-    api_key = users.ApiKey.query.filter(users.ApiKey.id==request.headers['API_ID']).first()
+        return None
+    key_id = request.headers['API_ID']
+    cache = get_verified_key_cache()
+    cache_key = (key_id, get_credential_digest(request.headers['API_KEY']))
+    cached = cache.get(cache_key)
+    if cached is not None:
+        # The cache is per process, so compare against the shared epoch that deleting or revoking the key changes.
+        user_id, epoch = cached
+        if get_api_key_epoch(key_id) == epoch:
+            return user_id
+        cache.delete(cache_key)
+
+    with replica_reads():
+        api_key = users.ApiKey.query.filter(users.ApiKey.id==key_id).first()
+    if not api_key and current_app.extensions.get('database_replicas'):
+        # The key may be newer than the replica, so check the primary before refusing it.
+        api_key = users.ApiKey.query.filter(users.ApiKey.id==key_id).first()
     if not api_key:
-        return False
-    if not current_app.user_manager.verify_password(request.headers['API_KEY'], api_key.hash):
+        return None
+    if not verify_api_key(api_key, request.headers['API_KEY']):
+        return None
+    cache.set(cache_key, (api_key.user_id, api_key.epoch))
+    return api_key.user_id
+
+
+def is_authorized_api_user(roles=False):
+    """Verify API Token and its owners permission to use it"""
+    token = load_api_token()
+    if token is not None:
+        return not roles or Permissions(token['r']).has_any(roles)
+    user_id = verify_api_credentials()
+    if user_id is None:
         return False
     if not roles:
         return True
-    if api_key.user.has_role('admin'):
-        return True
-    for role in roles:
-        if api_key.user.has_role(role):
-            return True
-    return False
+    user = users.User.query.get(user_id)
+    if not user:
+        return False
+    return user.permissions.has_any(roles)
 
 
 def roles_accepted_api(*role_names):
     def wrapper(view_function):
         @wraps(view_function)
         def decorated_view_function(*args, **kwargs):
+            enforce_api_rate_limits()
             if not is_authorized_api_user(role_names):
                 return abort(403)
             return view_function(*args, **kwargs)
@@ -39,6 +175,7 @@ def api_credentials_required():
     def wrapper(view_function):
         @wraps(view_function)
         def decorated_view_function(*args, **kwargs):
+            enforce_api_rate_limits()
             if not is_authorized_api_user():
                 return abort(403)
             return view_function(*args, **kwargs)
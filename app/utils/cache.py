@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from flask import _request_ctx_stack
+import threading
+import time
+
+
+class TTLCache(object):
+    """A bounded, thread safe, in-process LRU cache whose entries expire after a fixed number of seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Remove every entry whose key satisfies `predicate`."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._data)
+
+
+def request_cache(name):
+    """Return a dict that lives exactly as long as the current request, or None outside of a request.
+
+    Unlike `g` this is never shared between requests, even when a long lived app context is pushed."""
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return None
+    caches = getattr(ctx, 'request_caches', None)
+    if caches is None:
+        caches = ctx.request_caches = {}
+    return caches.setdefault(name, {})
+
+
+_missing = object()
@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def load_snapshot(path, name, key=None):
+    """Return (created, config) from a snapshot file, or None if it is missing, unreadable or fails its checksum"""
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        created = float(snapshot['created'])
+        config = snapshot['config']
+        checksum = snapshot['checksum']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if snapshot.get('name') != name:
+        return None
+    if not hmac.compare_digest(checksum, get_checksum(name, created, config, key)):
+        return None
+    return created, config
+
+
+def save_snapshot(path, name, config, key=None):
+    """Atomically write a snapshot readable only by the current user"""
+    created = time.time()
+    snapshot = {
+        'name': name,
+        'created': created,
+        'config': config,
+        'checksum': get_checksum(name, created, config, key),
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.config-snapshot-')
+    try:
+        with os.fdopen(handle, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return created
+
+
+def get_checksum(name, created, config, key=None):
+    payload = json.dumps([name, created, config], sort_keys=True).encode('utf-8')
+    if key:
+        return hmac.new(key.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+    return hashlib.sha256(payload).hexdigest()
+
+
+class ConfigSnapshot(object):
+    """Memoizes an expensive configuration lookup in process and, optionally, in a local file.
+
+    A snapshot younger than `ttl` is used as is. One up to twice that age is still used, but a background thread
+    fetches a replacement so the next process starts fresh. Anything older is fetched again before returning."""
+
+    def __init__(self, name, fetch, path=None, ttl=300, key=None):
+        self.name = name
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.key = key
+        self.config = None
+        self.created = None
+        self._refreshing = threading.Lock()
+
+    def get(self):
+        if self.config is not None and time.time() - self.created < self.ttl:
+            return self.config
+
+        if self.path:
+            snapshot = load_snapshot(self.path, self.name, self.key)
+            if snapshot is not None:
+                created, config = snapshot
+                age = time.time() - created
+                if age < self.ttl * 2:
+                    self.created, self.config = created, config
+                    if age >= self.ttl:
+                        self.refresh_in_background()
+                    return config
+
+        return self.refresh()
+
+    def refresh(self):
+        config = self.fetch()
+        created = time.time()
+        if self.path:
+            try:
+                created = save_snapshot(self.path, self.name, config, self.key)
+            except OSError:
+                pass  # An unwritable snapshot only costs the next process a remote call.
+        self.created, self.config = created, config
+        return config
+
+    def refresh_in_background(self):
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                pass  # Keep serving the current snapshot, the next expiry will try again.
+            finally:
+                self._refreshing.release()
+
+        thread = threading.Thread(target=run, name='config-snapshot-refresh', daemon=True)
+        thread.start()
+        return thread
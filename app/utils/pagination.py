@@ -0,0 +1,41 @@
+from collections import namedtuple
+
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'previous_cursor', 'next_cursor'])
+
+
+def keyset_page(query, column, page_size, after=None, before=None):
+    """Fetch one page of `query` ordered by the unique `column`.
+
+    Pages are addressed by the column value of the row they start after (or end before) rather than an
+    offset, so every page costs the same index range scan no matter how deep into the table it is."""
+    if before is not None:
+        rows = query.filter(column < before).order_by(column.desc()).limit(page_size + 1).all()
+        has_previous = len(rows) > page_size
+        items = list(reversed(rows[:page_size]))
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(column > after)
+        rows = query.order_by(column).limit(page_size + 1).all()
+        has_next = len(rows) > page_size
+        items = rows[:page_size]
+        has_previous = after is not None
+
+    key = column.key
+    previous_cursor = getattr(items[0], key) if items and has_previous else None
+    next_cursor = getattr(items[-1], key) if items and has_next else None
+    return KeysetPage(items, previous_cursor, next_cursor)
+
+
+def iter_keyset(query, column, batch_size=1000):
+    """Yield lists of rows from `query` in `column` order, one keyset page at a time"""
+    after = None
+    while True:
+        batch = keyset_page(query, column, batch_size, after=after)
+        if not batch.items:
+            return
+        yield batch.items
+        if batch.next_cursor is None:
+            return
+        after = batch.next_cursor
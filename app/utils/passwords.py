@@ -0,0 +1,30 @@
+from flask import current_app
+
+from app import db
+
+
+def get_password_context():
+    return current_app.user_manager.password_manager.password_crypt_context
+
+
+def password_needs_rehash(password_hash):
+    """Return True when a stored hash uses a deprecated scheme or a cost other than PASSWORD_HASH_ROUNDS"""
+    context = get_password_context()
+    if context.needs_update(password_hash):
+        return True
+    rounds = current_app.config.get('PASSWORD_HASH_ROUNDS', False)
+    if not rounds:
+        return False
+    handler = context.identify(password_hash, resolve=True)
+    if handler is None:
+        return False
+    return getattr(handler.from_string(password_hash), 'rounds', int(rounds)) != int(rounds)
+
+
+def rehash_password_if_needed(user, password):
+    """Rehash a user's password at the configured cost, given the plaintext from a successful login"""
+    if not user.password or not password_needs_rehash(user.password):
+        return False
+    user.password = current_app.user_manager.hash_password(password)
+    db.session.commit()
+    return True
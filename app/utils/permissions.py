@@ -0,0 +1,47 @@
+class Permissions(object):
+    """An immutable snapshot of the role names a user holds.
+
+    Membership checks are set lookups, and holding the 'admin' role satisfies any role check unless
+    `allow_admin` is turned off."""
+
+    __slots__ = ('_roles', '_is_admin')
+
+    def __init__(self, roles=()):
+        object.__setattr__(self, '_roles', frozenset(roles))
+        object.__setattr__(self, '_is_admin', 'admin' in self._roles)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Permissions are immutable')
+
+    @property
+    def roles(self):
+        return self._roles
+
+    def has_role(self, role, allow_admin=True):
+        if allow_admin and self._is_admin:
+            return True
+        return role in self._roles
+
+    def has_any(self, role_names, allow_admin=True):
+        if allow_admin and self._is_admin:
+            return True
+        return not self._roles.isdisjoint(role_names)
+
+    def has_roles(self, *requirements):
+        """Return True if every requirement is met.
+
+        A requirement is either a role name, which must be held, or a list or tuple of role names of which
+        at least one must be held."""
+        for requirement in requirements:
+            if isinstance(requirement, (list, tuple)):
+                if not self.has_any(requirement):
+                    return False
+            elif not self.has_role(requirement):
+                return False
+        return True
+
+    def __contains__(self, role):
+        return self.has_role(role)
+
+    def __repr__(self):
+        return 'Permissions(%r)' % (sorted(self._roles),)
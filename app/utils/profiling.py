@@ -0,0 +1,49 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+STAGE_PROFILE_SCRIPT = '''
+import json
+from app import create_app
+app = create_app()
+print(json.dumps(app.extensions['startup_timings']))
+'''
+
+
+class StartupTimer(object):
+    """Records how long each stage of application startup took, in seconds"""
+
+    def __init__(self):
+        self.stages = []
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+
+def profile_startup(cwd=None):
+    """Import the app and run create_app() in a fresh interpreter.
+
+    Returns the per module import times as (module, self seconds, cumulative seconds, depth) tuples and the
+    create_app() stage timings. A subprocess is used so nothing is already imported or cached."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STAGE_PROFILE_SCRIPT],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                            cwd=cwd or os.getcwd())
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'create_app() failed')
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((module, int(self_us) / 1e6, int(cumulative_us) / 1e6, (len(indent) - 1) // 2))
+    stages = json.loads(result.stdout.strip().splitlines()[-1])
+    return imports, stages
@@ -4,8 +4,10 @@ from flask_user import current_user, login_required, roles_accepted
 
 from flask import Flask, session, redirect, url_for, request, render_template, jsonify, abort
 from app import db
+from app.extensions.database import use_replica
 from app.models import user_models as users
 from app.utils import forms
+from app.utils.api import hash_api_key, invalidate_api_key
 
 import time
 import uuid
@@ -16,6 +18,7 @@ apikeys_blueprint = Blueprint('apikeys', __name__, template_folder='templates')
 
 
 @apikeys_blueprint.route('/user/apikeys')
+@use_replica
 @roles_accepted('dev', 'admin')
 def apikeys_index():
     all_keys = users.ApiKey.query.filter_by(user_id=current_user.id).all()
@@ -30,7 +33,7 @@ def apikeys_create():
         label = request.form.get('label', None)
         id = uuid.uuid4().hex[0:12]
         key = uuid.uuid4().hex
-        hash = current_app.user_manager.hash_password(key)
+        hash = hash_api_key(key)
         new_key = users.ApiKey(id=id, hash=hash, user_id=current_user.id, label=label)
         db.session.add(new_key)
         db.session.commit()
@@ -47,5 +50,6 @@ def apikeys_delete(key_id):
         if remove_key:
             db.session.delete(remove_key)
             db.session.commit()
+            invalidate_api_key(key_id)
         return redirect(url_for('apikeys.apikeys_index'))
     return render_template("apikeys/delete.html", form=form, key_id=key_id)
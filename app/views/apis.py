@@ -1,11 +1,13 @@
 # Copyright 2018 Twin Tech Labs. All rights reserved
 
 from flask import Blueprint, redirect
-from flask import request, url_for, jsonify, current_app
+from flask import request, url_for, jsonify, current_app, abort
 
 from app import db
 from app.models import user_models
-from app.utils.api import roles_accepted_api
+from app.extensions.rate_limit import enforce_api_rate_limits
+from app.utils.api import create_api_token, hash_api_key, roles_accepted_api, verify_api_credentials
+from app.utils.passwords import rehash_password_if_needed
 from app.extensions.ldap import authenticate
 
 import uuid
@@ -15,6 +17,7 @@ api_blueprint = Blueprint('api', __name__, template_folder='templates')
 
 @api_blueprint.route('/api/credentials', methods=['POST'])
 def api_create_credentials():
+    enforce_api_rate_limits()
     username = request.form['username']
     password = request.form['password']
     label = request.form.get('label', None)
@@ -30,12 +33,26 @@ def api_create_credentials():
     else:
         if not current_app.user_manager.verify_password(password, user.password):
             abort(401)
+        rehash_password_if_needed(user, password)
 
     id = uuid.uuid4().hex[0:12]
     key = uuid.uuid4().hex
-    hash = current_app.user_manager.hash_password(key)
+    hash = hash_api_key(key)
     new_key = user_models.ApiKey(id=id, hash=hash, user_id=user.id, label=label)
     db.session.add(new_key)
     db.session.commit()
 
     return jsonify({'id': id,'key': key})
+
+
+@api_blueprint.route('/api/token', methods=['POST'])
+def api_create_token():
+    """Trade API_ID and API_KEY headers for a short lived bearer token"""
+    enforce_api_rate_limits()
+    if verify_api_credentials() is None:
+        abort(401)
+    api_key = user_models.ApiKey.query.get(request.headers['API_ID'])
+    if not api_key:
+        abort(401)
+    ttl = current_app.config.get('API_TOKEN_TTL', 300)
+    return jsonify({'token': create_api_token(api_key), 'token_type': 'Bearer', 'expires_in': ttl})
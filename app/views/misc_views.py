@@ -2,11 +2,18 @@
 
 from flask import Blueprint, redirect, render_template, current_app, abort
 from flask import request, url_for, flash, send_from_directory, jsonify, render_template_string
+from flask import Response, stream_with_context
 from flask_user import current_user, login_required, roles_accepted
 
 from app import db
-from app.models.user_models import UserProfileForm, User, UsersRoles, Role
+from app.extensions.database import replica_reads, use_replica
+from app.extensions.query_tracking import query_budget
+from app.models.user_models import ApiKey, UserProfileForm, User, UsersRoles, Role
+from app.utils.api import revoke_api_tokens
+from app.utils.export import EXPORT_FORMATS, export_users
 from app.utils.forms import ConfirmationForm
+from app.utils.pagination import keyset_page
+from sqlalchemy.orm import selectinload
 import uuid, json, os
 import datetime
 
@@ -27,10 +34,31 @@ def admin_page():
     return redirect(url_for('main.user_admin_page'))
 
 @main_blueprint.route('/users')
+@use_replica
 @roles_accepted('admin')
+@query_budget(6)
 def user_admin_page():
-    users = User.query.all()
-    return render_template('pages/admin/users.html', users=users)
+    page = keyset_page(User.query.options(selectinload(User.roles)), User.id,
+                       current_app.config.get('USER_ADMIN_PAGE_SIZE', 50),
+                       after=request.args.get('after', type=int),
+                       before=request.args.get('before', type=int))
+    return render_template('pages/admin/users.html', users=page.items, page=page)
+
+@main_blueprint.route('/users/export.<export_format>')
+@use_replica
+@roles_accepted('admin')
+def export_users_page(export_format):
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+
+    # The body is generated after the view returns, so it needs its own replica block.
+    def generate():
+        with replica_reads():
+            yield from export_users(export_format)
+
+    return Response(stream_with_context(generate()),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': 'attachment; filename=users.%s' % (export_format,)})
 
 @main_blueprint.route('/create_user', methods=['GET', 'POST'])
 @roles_accepted('admin')
@@ -78,6 +106,8 @@ def delete_user_page(user_id):
     if not user:
         abort(404)
     if form.validate():
+        revoke_api_tokens(user.id)
+        db.session.query(ApiKey).filter_by(user_id = user_id).delete()
         db.session.query(UsersRoles).filter_by(user_id = user_id).delete()
         db.session.query(User).filter_by(id = user_id).delete()
         db.session.commit()
@@ -88,6 +118,7 @@ def delete_user_page(user_id):
 
 @main_blueprint.route('/users/<user_id>/edit', methods=['GET', 'POST'])
 @roles_accepted('admin')
+@query_budget(10)
 def edit_user_page(user_id):
     if current_app.config.get('USER_LDAP', False):
         abort(400)
@@ -118,6 +149,8 @@ def edit_user_page(user_id):
                     user.roles.append(role)
 
         db.session.commit()
+        # Tokens carry the roles they were issued with, so replace them.
+        revoke_api_tokens(user.id)
         flash('You successfully edited the user.', 'success')
         return redirect(url_for('main.user_admin_page'))
 
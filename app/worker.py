@@ -1,10 +1,12 @@
-from app import celery, create_app
+from app import create_app, get_celery
 
 # Make sure to import your celery tasks here!
 # Otherwise the worker will not pick them up.
+from app.tasks import cache, ldap, mail, rate_limit, sessions
 
 
 app = create_app()
+celery = get_celery()
 
-with app.app_context():
-    celery.start()
+# Tasks push their own application context, see app.tasks.base.AppTask.
+celery.start()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""Measure throughput and latency of the request hot paths against a seeded database.
+
+Requests go through the Flask test client, so the numbers cover the application (routing, sessions, auth, SQL and
+templates) but not a web server. By default everything runs offline against a temporary SQLite database:
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --database postgresql://localhost/bench --reset --compare results.json
+
+A --database is emptied and reseeded, so only point it at a disposable database.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify
+
+PASSWORD = 'Password1'
+SEED_CHUNK_SIZE = 5000
+
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(name, timings, errors, elapsed, **extra):
+    ordered = sorted(timings)
+    result = {
+        'scenario': name,
+        'requests': len(timings),
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(timings) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+    }
+    for label, fraction in (('p50_ms', .5), ('p95_ms', .95), ('p99_ms', .99), ('max_ms', 1)):
+        value = percentile(ordered, fraction)
+        result[label] = round(value * 1000, 3) if value is not None else None
+    result.update(extra)
+    return result
+
+
+def measure(name, request, iterations, warmup, expected_status, **extra):
+    """Call `request()` `iterations` times after `warmup` unmeasured calls and summarize the timings"""
+    for _ in range(warmup):
+        request()
+    timings = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = request()
+        timings.append(time.perf_counter() - start)
+        if response.status_code != expected_status:
+            errors += 1
+    return summarize(name, timings, errors, time.perf_counter() - started, **extra)
+
+
+def create_benchmark_app(database_uri, cache_root, hash_rounds=None):
+    from app import create_app
+    from app.utils.api import api_credentials_required
+
+    config = dict(
+        SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark-only-secret-key-0123456789'),
+        SQLALCHEMY_DATABASE_URI=database_uri,
+        SERVER_NAME='localhost',
+        WTF_CSRF_ENABLED=False,
+        MAIL_SUPPRESS_SEND=True,
+        CACHE_ROOT=cache_root,
+        QUERY_TRACKING=False,
+        USER_ADMIN_PAGE_SIZE=50,
+        # Keep the rate limit checks in the measured path without ever refusing a benchmark request.
+        API_RATE_LIMIT_IP=(10 ** 9, 60),
+        API_RATE_LIMITS={'default': (10 ** 9, 60)},
+    )
+    if hash_rounds:
+        config['PASSWORD_HASH_ROUNDS'] = hash_rounds
+    app = create_app(config)
+
+    # The application has no API endpoint beyond issuing credentials, so measure the authentication on a stub.
+    @app.route('/benchmark/api')
+    @api_credentials_required()
+    def benchmark_api():
+        return jsonify({'ok': True})
+
+    return app
+
+
+def reset_database(app):
+    from app import db
+    from app.commands.user import find_or_create_role, find_or_create_user
+
+    db.drop_all()
+    db.create_all()
+    admin = find_or_create_role('admin', u'Admin')
+    find_or_create_role('dev', u'Developer')
+    find_or_create_role('user', u'User')
+    find_or_create_user(u'Admin', u'Example', None, u'admin@example.com', PASSWORD, admin)
+    find_or_create_user(u'Member', u'Example', None, u'member@example.com', PASSWORD)
+
+
+def seed_users(app, total):
+    """Add generated users, each with the 'user' role, until the users table holds `total` rows"""
+    from app import db
+    from app.models.user_models import Role, User, UsersRoles
+
+    existing = User.query.count()
+    if existing >= total:
+        return existing
+    # One hash for every generated user, hashing each one would dominate seeding time.
+    password = app.user_manager.hash_password(PASSWORD)
+    role_id = Role.query.filter(Role.name == 'user').one().id
+    now = datetime.datetime.utcnow()
+    users_table = User.__table__
+    roles_table = UsersRoles.__table__
+
+    for start in range(existing, total, SEED_CHUNK_SIZE):
+        stop = min(start + SEED_CHUNK_SIZE, total)
+        emails = ['seed%07d@example.com' % number for number in range(start, stop)]
+        db.session.execute(users_table.insert(), [
+            {'email': email, 'password': password, 'is_active': True, 'first_name': u'Seed',
+             'last_name': u'User %d' % number, 'email_confirmed_at': now}
+            for number, email in zip(range(start, stop), emails)])
+        ids = db.session.query(User.id).filter(User.email.in_(emails)).all()
+        db.session.execute(roles_table.insert(), [{'user_id': user_id, 'role_id': role_id} for user_id, in ids])
+        db.session.commit()
+    return total
+
+
+def sign_in(app, email):
+    client = app.test_client()
+    response = client.post('/user/sign-in', data={'email': email, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError('Could not sign in as %s' % (email,))
+    return client
+
+
+def run_benchmarks(app, user_counts, iterations, warmup, login_iterations):
+    from app import db
+    from app.models.user_models import User
+
+    results = []
+    reset_database(app)
+
+    results.append(measure('login', lambda: app.test_client().post(
+        '/user/sign-in', data={'email': 'member@example.com', 'password': PASSWORD}),
+        login_iterations, min(warmup, 2), 302))
+
+    api_client = app.test_client()
+    results.append(measure('api_create_credentials', lambda: api_client.post(
+        '/api/credentials', data={'username': 'admin@example.com', 'password': PASSWORD}),
+        login_iterations, min(warmup, 2), 200))
+
+    credentials = api_client.post('/api/credentials',
+                                  data={'username': 'admin@example.com', 'password': PASSWORD}).get_json()
+    headers = {'API_ID': credentials['id'], 'API_KEY': credentials['key']}
+    results.append(measure('api_authenticated_call', lambda: api_client.get('/benchmark/api', headers=headers),
+                           iterations, warmup, 200))
+
+    member = sign_in(app, 'member@example.com')
+    results.append(measure('profile_page', lambda: member.get('/pages/profile'), iterations, warmup, 200))
+
+    admin = sign_in(app, 'admin@example.com')
+    for count in user_counts:
+        started = time.perf_counter()
+        seed_users(app, count)
+        print('Seeded %d users in %.1fs' % (count, time.perf_counter() - started), file=sys.stderr)
+        last_id = db.session.query(db.func.max(User.id)).scalar()
+        results.append(measure('user_admin_page', lambda: admin.get('/users'), iterations, warmup, 200,
+                               users=count))
+        results.append(measure('user_admin_page_last', lambda: admin.get('/users?before=%d' % (last_id + 1,)),
+                               iterations, warmup, 200, users=count))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result['scenario'], result.get('users')
+
+
+def print_results(results, previous=None):
+    baseline = {result_key(result): result for result in (previous or [])}
+    print('%-24s %7s %8s %10s %9s %9s %9s %9s' % ('scenario', 'users', 'requests', 'req/s', 'p50 ms', 'p95 ms',
+                                                   'p99 ms', 'errors'))
+    for result in results:
+        line = '%-24s %7s %8d %10.1f %9.2f %9.2f %9.2f %9d' % (
+            result['scenario'], result.get('users', ''), result['requests'], result['throughput'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors'])
+        before = baseline.get(result_key(result))
+        if before and before.get('p95_ms'):
+            line += '   p95 %+.1f%%' % ((result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='SQLAlchemy URI of a disposable database, defaults to a temporary SQLite file')
+    parser.add_argument('--reset', action='store_true', help='Confirm that --database may be emptied and reseeded')
+    parser.add_argument('--users', default='1000,10000,100000', help='Comma separated user counts for the admin page')
+    parser.add_argument('--iterations', type=int, default=200, help='Measured requests per scenario')
+    parser.add_argument('--login-iterations', type=int, default=20,
+                        help='Measured requests for the scenarios that hash a password')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests before each scenario')
+    parser.add_argument('--hash-rounds', type=int, default=None, help='Override PASSWORD_HASH_ROUNDS')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Show the p95 change against an earlier results file')
+    args = parser.parse_args(argv)
+
+    if args.database and not args.reset:
+        parser.error('--database is emptied and reseeded, pass --reset to confirm')
+
+    workdir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        database_uri = args.database or 'sqlite:///%s' % (os.path.join(workdir, 'benchmark.sqlite'),)
+        app = create_benchmark_app(database_uri, os.path.join(workdir, 'cache'), args.hash_rounds)
+        user_counts = [int(count) for count in args.users.split(',') if count.strip()]
+        with app.app_context():
+            results = run_benchmarks(app, user_counts, args.iterations, args.warmup, args.login_iterations)
+            dialect = app.extensions['sqlalchemy'].db.engine.dialect.name
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            previous = json.load(compare_file)['results']
+    print_results(results, previous)
+
+    if args.output:
+        report = {
+            'created': datetime.datetime.utcnow().isoformat() + 'Z',
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': dialect,
+            'iterations': args.iterations,
+            'login_iterations': args.login_iterations,
+            'warmup': args.warmup,
+            'results': results,
+        }
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
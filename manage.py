@@ -5,11 +5,12 @@ Use "python manage.py runserver" to start the development web server on localhos
 Use "python manage.py runserver --help" for additional runserver options.
 """
 
-from flask import Flask
+from flask import Flask, current_app
 #from flask_migrate import MigrateCommand
 from flask.cli import FlaskGroup
 
 import click
+import os
 
 from app import create_app
 
@@ -52,6 +53,96 @@ def add_role(name, label):
 
 
 
+@cli.command(help='Export users, their roles and API key labels')
+@click.option('-f', '--format', 'export_format', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('-o', '--output', default='-', help='File to write to, defaults to stdout')
+@click.option('-b', '--batch-size', default=1000)
+def export_users(export_format, output, batch_size):
+    from app.utils.export import export_users
+    with click.open_file(output, 'w') as output_file:
+        for chunk in export_users(export_format, batch_size):
+            output_file.write(chunk)
+
+
+@cli.command(help='Create or update users from a CSV or JSON Lines file')
+@click.argument('input_file', type=click.File('r'))
+@click.option('-f', '--format', 'input_format', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Input format, guessed from the file extension by default')
+@click.option('-b', '--batch-size', default=1000)
+@click.option('-p', '--processes', default=None, type=int, help='Password hashing processes, defaults to the CPU count')
+@click.option('--update-passwords', is_flag=True, default=False, help='Also reset the passwords of existing users')
+def import_users(input_file, input_format, batch_size, processes, update_passwords):
+    if not input_format:
+        input_format = 'jsonl' if input_file.name.endswith(('.jsonl', '.json')) else 'csv'
+    records = user.read_user_records(input_file, input_format)
+    report = lambda totals: click.echo(
+        'Created %(created)s, updated %(updated)s, skipped %(skipped)s, rejected %(rejected)s users.' % totals)
+    user.import_users(records, batch_size, processes, update_passwords, progress=report)
+
+
+@cli.command(help='Copy users and group memberships from LDAP into the database')
+@click.option('--full', is_flag=True, default=False, help='Resync every entry and deactivate users missing from LDAP')
+def sync_ldap(full):
+    if not current_app.config.get('USER_LDAP', False):
+        raise click.UsageError("LDAP is not enabled")
+    from app.extensions.ldap_sync import sync_directory
+    result = sync_directory(full=full)
+    click.echo('Synced %s users and %s roles.' % (result['users'], result['roles']))
+
+
+@cli.command(help='Delete expired Beaker session, cache and lock files under CACHE_ROOT')
+@click.option('-b', '--batch-size', default=500, help='Files deleted between pauses')
+@click.option('-p', '--pause', default=0.05, help='Seconds to pause after each batch')
+def sweep_cache(batch_size, pause):
+    from app.extensions.cache_sweeper import sweep_cache_root
+    results = sweep_cache_root(batch_size=batch_size, pause=pause)
+    if not results:
+        click.echo('Only the file cache backend needs sweeping.')
+        return
+    for name, result in results.items():
+        click.echo('%-12s %8d files %12d bytes removed, %d busy' % (name, result['files'], result['bytes'], result['busy']))
+
+
+@cli.command(help='Delete expired sessions from the database session store')
+@click.option('-b', '--batch-size', default=1000, help='Sessions deleted per transaction')
+def purge_sessions(batch_size):
+    from app.extensions.sessions import purge_expired_sessions
+    click.echo('Removed %s expired sessions.' % (purge_expired_sessions(batch_size=batch_size),))
+
+
+@cli.command(help='Measure password hashing time and recommend a cost factor')
+@click.option('-t', '--target-ms', default=250.0, help='Longest acceptable time to hash one password')
+@click.option('-w', '--write', 'settings_file', default=None, type=click.Path(dir_okay=False),
+              help='Write PASSWORD_HASH_ROUNDS to this settings file')
+def benchmark_password_hash(target_ms, settings_file):
+    from app.commands import passwords
+    scheme = current_app.config.get('USER_PASSLIB_CRYPTCONTEXT_SCHEMES', ['bcrypt'])[0]
+    report = lambda rounds, elapsed: click.echo('%s rounds %2d: %8.1f ms' % (scheme, rounds, elapsed))
+    rounds = passwords.benchmark_rounds(target_ms, scheme, report=report)
+    click.echo('Recommended PASSWORD_HASH_ROUNDS = %s (currently %s)' % (rounds, current_app.config.get('PASSWORD_HASH_ROUNDS', False)))
+    if settings_file:
+        passwords.write_setting(settings_file, 'PASSWORD_HASH_ROUNDS', rounds)
+        click.echo('Wrote PASSWORD_HASH_ROUNDS = %s to %s' % (rounds, settings_file))
+
+
+@cli.command(help='Report module import costs and create_app() stage timings')
+@click.option('-n', '--top', default=25, help='Number of modules to list')
+def startup_profile(top):
+    from app.utils.profiling import profile_startup
+    imports, stages = profile_startup(os.path.dirname(os.path.abspath(__file__)))
+
+    click.echo('Slowest imports (cumulative, self):')
+    for module, self_time, cumulative, depth in sorted(imports, key=lambda item: -item[2])[:top]:
+        click.echo('  %8.1f ms %8.1f ms  %s' % (cumulative * 1000, self_time * 1000, module))
+    total_imports = sum(item[1] for item in imports)
+    click.echo('  %8.1f ms total import time' % (total_imports * 1000,))
+
+    click.echo('create_app() stages:')
+    for stage, elapsed in stages:
+        click.echo('  %8.1f ms  %s' % (elapsed * 1000, stage))
+    click.echo('  %8.1f ms total' % (sum(elapsed for stage, elapsed in stages) * 1000,))
+
+
 @cli.command(help='Change the password of a user')
 @click.argument('email')
 @click.argument('password', required=False)
@@ -7,7 +7,9 @@
 # Authors: Ling Thio <ling.thio@gmail.com>
 
 import pytest
+import tempfile
 from app import create_app, db as the_db
+from app.extensions.query_tracking import query_budget as the_query_budget
 
 # Initialize the Flask-App with test-specific settings
 the_app = create_app(dict(
@@ -17,14 +19,19 @@ the_app = create_app(dict(
     SERVER_NAME='localhost',  # Enable url_for() without request context
     SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',  # In-memory SQLite DB
     WTF_CSRF_ENABLED=False,  # Disable CSRF form validation
+    SECRET_KEY='test-secret-key-not-for-production',  # Sign sessions and API tokens
+    CACHE_ROOT=tempfile.mkdtemp(prefix='tests-cache-'),  # Start every run with an empty file cache
 ))
 
 # Setup an application context (since the tests run outside of the webserver context)
 the_app.app_context().push()
 
 # Create and populate roles and users tables
-from app.commands.init_db import init_db
-init_db()
+from app.commands.user import find_or_create_role, find_or_create_user
+the_db.create_all()
+find_or_create_user(u'Admin', u'Example', None, u'admin@example.com', 'Password1',
+                    find_or_create_role('admin', u'Admin'))
+find_or_create_user(u'Member', u'Example', None, u'member@example.com', 'Password1')
 
 
 @pytest.fixture(scope='session')
@@ -61,3 +68,11 @@ def session(db, request):
 def client(app):
     return app.test_client()
 
+@pytest.fixture(scope='session')
+def query_budget():
+    """ Makes the 'query_budget' parameter available to test functions, to fail tests that run too many queries.
+
+        with query_budget(5):
+            client.get('/users')
+    """
+    return the_query_budget
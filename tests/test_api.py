@@ -0,0 +1,132 @@
+from flask import jsonify, url_for
+from itsdangerous import TimestampSigner
+import pytest
+import time
+
+from app.commands.user import find_or_create_role, find_or_create_user
+from app.models.user_models import ApiKey, User
+from app.utils.api import API_KEY_HASH_PREFIX, api_credentials_required, create_api_token, get_api_key_epoch, \
+    get_verified_key_cache, hash_api_key, roles_accepted_api, verify_api_key
+
+
+@pytest.fixture(scope='module')
+def api_routes(app):
+    """Registers stub API routes, as the application has none beyond issuing credentials."""
+    if 'test_api_member' not in app.view_functions:
+        @app.route('/test/api/member')
+        @api_credentials_required()
+        def test_api_member():
+            return jsonify({'ok': True})
+
+        @app.route('/test/api/admin')
+        @roles_accepted_api('admin')
+        def test_api_admin():
+            return jsonify({'ok': True})
+    return app
+
+
+def create_credentials(client, username='member@example.com', password='Password1'):
+    response = client.post('/api/credentials', data={'username': username, 'password': password})
+    assert response.status_code == 200
+    credentials = response.get_json()
+    return {'API_ID': credentials['id'], 'API_KEY': credentials['key']}
+
+
+def test_keys_are_stored_as_keyed_digests():
+    stored = ApiKey(id='digest', hash=hash_api_key('secret-key'), user_id=1)
+    assert stored.hash.startswith(API_KEY_HASH_PREFIX)
+    assert 'secret-key' not in stored.hash
+    assert verify_api_key(stored, 'secret-key')
+    assert not verify_api_key(stored, 'other-key')
+
+
+def test_legacy_password_hashes_are_upgraded_on_first_use(api_routes, app, client, db):
+    member = User.query.filter_by(email='member@example.com').one()
+    db.session.add(ApiKey(id='legacy', hash=app.user_manager.hash_password('legacy-key'), user_id=member.id))
+    db.session.commit()
+
+    assert client.get('/test/api/member', headers={'API_ID': 'legacy', 'API_KEY': 'wrong-key'}).status_code == 403
+    assert not ApiKey.query.get('legacy').hash.startswith(API_KEY_HASH_PREFIX)
+
+    assert client.get('/test/api/member', headers={'API_ID': 'legacy', 'API_KEY': 'legacy-key'}).status_code == 200
+    db.session.expire_all()
+    assert ApiKey.query.get('legacy').hash == hash_api_key('legacy-key')
+
+
+def test_deleted_key_is_rejected_by_processes_that_cached_it(api_routes, client, db):
+    headers = create_credentials(client)
+    assert client.get('/test/api/member', headers=headers).status_code == 200
+    assert len([key for key in get_verified_key_cache()._data if key[0] == headers['API_ID']]) == 1
+
+    # Another process deletes the key. It can only reach the shared epoch cache, not this process's verified keys.
+    ApiKey.query.filter(ApiKey.id == headers['API_ID']).delete()
+    db.session.commit()
+    get_api_key_epoch.invalidate(headers['API_ID'])
+
+    assert client.get('/test/api/member', headers=headers).status_code == 403
+
+
+def create_token(client, headers):
+    response = client.post('/api/token', headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['token_type'] == 'Bearer'
+    return {'Authorization': 'Bearer %s' % (response.get_json()['token'],)}
+
+
+def test_tokens_carry_the_roles_of_the_key_owner(api_routes, client):
+    member_token = create_token(client, create_credentials(client))
+    admin_token = create_token(client, create_credentials(client, 'admin@example.com'))
+    assert client.get('/test/api/member', headers=member_token).status_code == 200
+    assert client.get('/test/api/admin', headers=member_token).status_code == 403
+    assert client.get('/test/api/admin', headers=admin_token).status_code == 200
+
+
+def test_tokens_need_valid_credentials(api_routes, client):
+    headers = create_credentials(client)
+    assert client.post('/api/token', headers=dict(headers, API_KEY='wrong')).status_code == 401
+    assert client.get('/test/api/member', headers={'Authorization': 'Bearer nonsense'}).status_code == 403
+
+
+def test_editing_the_owner_revokes_tokens(api_routes, app, client):
+    user = find_or_create_user(u'Token', u'Example', None, u'token@example.com', 'Password1',
+                               find_or_create_role('admin', u'Admin'))
+    token = create_token(client, create_credentials(client, 'token@example.com'))
+    assert client.get('/test/api/admin', headers=token).status_code == 200
+
+    admin = app.test_client()
+    admin.post(url_for('user.login'), data={'email': 'admin@example.com', 'password': 'Password1'})
+    response = admin.post('/users/%s/edit' % (user.id,), data={
+        'email': 'token@example.com', 'first_name': 'Token', 'last_name': 'Example', 'active': 'y', 'roles': []})
+    assert response.status_code in (200, 302)
+    assert ApiKey.query.filter(ApiKey.user_id == user.id).first().epoch == 1
+
+    assert client.get('/test/api/admin', headers=token).status_code == 403
+    assert client.get('/test/api/member', headers=token).status_code == 403
+
+
+def test_deleting_the_key_revokes_tokens(api_routes, client, db):
+    headers = create_credentials(client)
+    token = create_token(client, headers)
+    assert client.get('/test/api/member', headers=token).status_code == 200
+
+    ApiKey.query.filter(ApiKey.id == headers['API_ID']).delete()
+    db.session.commit()
+    get_api_key_epoch.invalidate(headers['API_ID'])
+    assert client.get('/test/api/member', headers=token).status_code == 403
+
+
+def test_expired_tokens_are_rejected(api_routes, app, client, monkeypatch):
+    headers = create_credentials(client)
+    ttl = app.config.get('API_TOKEN_TTL', 300)
+    monkeypatch.setattr(TimestampSigner, 'get_timestamp', lambda signer: int(time.time()) - ttl - 10)
+    token = create_api_token(ApiKey.query.get(headers['API_ID']))
+    monkeypatch.undo()
+    assert client.get('/test/api/member', headers={'Authorization': 'Bearer %s' % (token,)}).status_code == 403
+
+
+def test_tampered_tokens_are_rejected(api_routes, client):
+    token = create_token(client, create_credentials(client))['Authorization']
+    payload, rest = token[len('Bearer '):].split('.', 1)
+    tampered = payload[:-1] + ('A' if payload[-1] != 'A' else 'B')
+    response = client.get('/test/api/admin', headers={'Authorization': 'Bearer %s.%s' % (tampered, rest)})
+    assert response.status_code == 403
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+from flask import Flask
+
+from app.extensions.cache import AppCache
+
+
+def make_cache(cache_root, **config):
+    """An AppCache on a file backend under `cache_root`, as each process of one host would have"""
+    app = Flask(__name__)
+    app.config.update(CACHE_EXPIRE=3600, CACHE_LOCAL_TTL=30, **config)
+    cache = AppCache()
+    cache.init_app(app, {'cache.type': 'file', 'cache.data_dir': str(cache_root / 'data'),
+                         'cache.lock_dir': str(cache_root / 'lock')})
+    return cache
+
+
+def test_values_are_served_from_the_local_tier_then_the_backend(tmp_path):
+    cache = make_cache(tmp_path)
+    region = cache.region('users')
+    assert region.get('alice', 'missing') == 'missing'
+
+    region.set('alice', {'id': 1})
+    assert region.get('alice') == {'id': 1}
+    region.local.clear()
+    assert region.get('alice') == {'id': 1}
+    assert region.get('alice') == {'id': 1}
+    assert region.stats() == {'misses': 1, 'local_hits': 2, 'backend_hits': 1, 'local_size': 1}
+
+
+def test_regions_expire_as_configured(tmp_path):
+    cache = make_cache(tmp_path, CACHE_REGIONS={'short': 1})
+    assert cache.region('short').expire == 1
+    assert cache.region('short').local.ttl == 1
+    assert cache.region('other').expire == 3600
+    assert cache.region('other').local.ttl == 30
+
+    cache.set('short', 'key', 'value')
+    cache.set('other', 'key', 'value')
+    time.sleep(1.1)
+    assert cache.get('short', 'key') is None
+    assert cache.get('other', 'key') == 'value'
+
+
+def test_invalidating_a_memoized_value_reaches_both_tiers(tmp_path):
+    calls = []
+    caches = [make_cache(tmp_path), make_cache(tmp_path)]
+    lookups = []
+    for cache in caches:
+        @cache.memoize('epochs', key=lambda key_id: key_id)
+        def lookup(key_id):
+            calls.append(key_id)
+            return len(calls)
+        lookups.append(lookup)
+
+    assert lookups[0]('key') == 1
+    assert lookups[1]('key') == 1
+    assert calls == ['key']
+
+    lookups[0].invalidate('key')
+    assert lookups[0]('key') == 2
+    # The other process keeps its local copy until CACHE_LOCAL_TTL, then reads the new value from the backend.
+    assert lookups[1]('key') == 1
+    caches[1].region('epochs').local.clear()
+    assert lookups[1]('key') == 2
+    assert calls == ['key', 'key']
+
+
+def test_none_results_are_cached(tmp_path):
+    cache = make_cache(tmp_path)
+    calls = []
+
+    @cache.memoize('epochs')
+    def lookup(key_id):
+        calls.append(key_id)
+        return None
+
+    assert lookup('deleted') is None
+    assert lookup('deleted') is None
+    cache.region('epochs').local.clear()
+    assert lookup('deleted') is None
+    assert calls == ['deleted']
+
+
+def test_regions_need_an_initialized_cache():
+    with pytest.raises(RuntimeError):
+        AppCache().region('users')
@@ -0,0 +1,94 @@
+import fcntl
+import hashlib
+import os
+import time
+
+from beaker.cache import CacheManager
+from beaker.session import Session
+from beaker.util import encoded_path
+from flask import Flask
+
+from app.extensions.cache_sweeper import sweep_cache_root
+
+
+def files_below(root):
+    return sorted(os.path.relpath(os.path.join(dirpath, filename), root)
+                  for dirpath, dirnames, filenames in os.walk(root) for filename in filenames)
+
+
+def age(root, paths, seconds):
+    stamp = time.time() - seconds
+    for path in paths:
+        os.utime(os.path.join(root, path), (stamp, stamp))
+
+
+def make_session(root, session_id):
+    session = Session({}, id=session_id, use_cookies=False, type='file', data_dir=str(root / 'session'))
+    session['value'] = session_id
+    session.save()
+
+
+def sweep(root, **config):
+    app = Flask(__name__)
+    app.config.update(dict({'CACHE_TYPE': 'file', 'CACHE_ROOT': str(root), 'CACHE_EXPIRE': 600,
+                            'SESSION_COOKIE_EXPIRES': 600}, **config))
+    with app.app_context():
+        return sweep_cache_root(batch_size=1, pause=0)
+
+
+def test_expired_files_are_removed_and_the_rest_kept(tmp_path):
+    make_session(tmp_path, 'expiredsession')
+    make_session(tmp_path, 'livesession')
+    cache = CacheManager(type='file', data_dir=str(tmp_path / 'data'), lock_dir=str(tmp_path / 'lock'))
+    cache.get_cache('expired', expire=600).put('key', 'value')
+    cache.get_cache('live', expire=600).put('key', 'value')
+    orphan_lock = encoded_path(str(tmp_path / 'lock'), ['orphan'], extension='.lock')
+    open(orphan_lock, 'w').close()
+    age(tmp_path, [orphan_lock], 3600)
+    (tmp_path / 'data' / 'notes.txt').write_text('not a cache file')
+    (tmp_path / 'unrelated.cache').write_text('outside every store')
+
+    # Cache files and every lock file are named after the sha1 of their namespace, session files after the session id.
+    names = {name: hashlib.sha1(name.encode('utf-8')).hexdigest() for name in ('expired', 'live', 'expiredsession',
+                                                                             'livesession')}
+    names.update(expiredsession_file='expiredsession.cache', livesession_file='livesession.cache')
+    before = files_below(tmp_path)
+    expired = [path for path in before if os.path.basename(path).startswith(
+        (names['expired'], names['expiredsession'], names['expiredsession_file']))]
+    live = [path for path in before if os.path.basename(path).startswith(
+        (names['live'], names['livesession'], names['livesession_file']))]
+    assert len(expired) == len(live) == 4
+    age(tmp_path, expired, 3600)
+
+    result = sweep(tmp_path)
+
+    after = files_below(tmp_path)
+    # The lock of each removed entry goes with it, so only the orphaned lock is left for the lock sweep.
+    assert [result[store]['files'] for store in ('session', 'session_lock', 'data', 'lock')] == [1, 0, 1, 1]
+    assert not any(path in after for path in expired)
+    assert not os.path.exists(orphan_lock)
+    assert all(path in after for path in live)
+    assert os.path.join('data', 'notes.txt') in after
+    assert 'unrelated.cache' in after
+
+
+def test_files_in_use_are_skipped(tmp_path):
+    make_session(tmp_path, 'busysession')
+    session_file = next(path for path in files_below(tmp_path) if path.endswith('busysession.cache'))
+    age(tmp_path, [session_file], 3600)
+
+    lock_dir = tmp_path / 'session' / 'container_file_lock'
+    lock_path = encoded_path(str(lock_dir), ['busysession'], extension='.lock')
+    descriptor = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+        result = sweep(tmp_path)
+    finally:
+        os.close(descriptor)
+
+    assert result['session'] == {'files': 0, 'bytes': 0, 'busy': 1}
+    assert session_file in files_below(tmp_path)
+
+
+def test_other_backends_are_not_swept(tmp_path):
+    assert sweep(tmp_path, CACHE_TYPE='memcached') == {}
@@ -0,0 +1,69 @@
+import json
+
+from botocore.stub import Stubber
+import boto3
+
+import app as app_module
+from app.utils.config_snapshot import ConfigSnapshot
+
+
+class CountingFetch(object):
+    def __init__(self, config):
+        self.config = config
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.config
+
+
+def test_fresh_snapshot_skips_fetch(tmpdir):
+    path = str(tmpdir.join('snapshot.json'))
+    fetch = CountingFetch({'SECRET_KEY': 'from-secrets-manager'})
+
+    assert ConfigSnapshot('app-config', fetch, path=path).get() == {'SECRET_KEY': 'from-secrets-manager'}
+    # A new process finds the snapshot on disk and makes no remote call.
+    assert ConfigSnapshot('app-config', fetch, path=path).get() == {'SECRET_KEY': 'from-secrets-manager'}
+    assert fetch.calls == 1
+
+
+def test_tampered_snapshot_is_ignored(tmpdir):
+    path = str(tmpdir.join('snapshot.json'))
+    fetch = CountingFetch({'SECRET_KEY': 'real'})
+    ConfigSnapshot('app-config', fetch, path=path, key='signing-key').get()
+
+    with open(path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    snapshot['config']['SECRET_KEY'] = 'forged'
+    with open(path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+
+    assert ConfigSnapshot('app-config', fetch, path=path, key='signing-key').get() == {'SECRET_KEY': 'real'}
+    assert fetch.calls == 2
+
+
+def test_expired_snapshot_is_refetched(tmpdir):
+    path = str(tmpdir.join('snapshot.json'))
+    fetch = CountingFetch({'SECRET_KEY': 'real'})
+    ConfigSnapshot('app-config', fetch, path=path).get()
+
+    ConfigSnapshot('app-config', fetch, path=path, ttl=0).get()
+    assert fetch.calls == 2
+
+
+def test_load_secrets_from_secrets_manager_stub(monkeypatch, tmpdir):
+    client = boto3.client('secretsmanager', region_name='us-east-1',
+                          aws_access_key_id='testing', aws_secret_access_key='testing')
+    stubber = Stubber(client)
+    stubber.add_response('get_secret_value', {'SecretString': 'APP_NAME: Stubbed\nMAIL_PORT: 2525\n'},
+                         {'SecretId': 'stub-config'})
+    monkeypatch.setattr(app_module, 'get_secrets_client', lambda region: client)
+    monkeypatch.setenv('AWS_SECRETS_REGION', 'us-east-1')
+    monkeypatch.setattr(app_module, '_secret_snapshots', {})
+    config = {'CONFIG_SNAPSHOT_PATH': str(tmpdir.join('snapshot.json'))}
+
+    with stubber:
+        assert app_module.load_secrets('stub-config', config) == {'APP_NAME': 'Stubbed', 'MAIL_PORT': 2525}
+        # Served from the in-process snapshot, the stub would raise on a second call.
+        assert app_module.load_secrets('stub-config', config) == {'APP_NAME': 'Stubbed', 'MAIL_PORT': 2525}
+    stubber.assert_no_pending_responses()
@@ -0,0 +1,93 @@
+from flask import Flask, jsonify
+import pytest
+
+from app import db
+from app.extensions.database import PRIMARY_COOKIE, configure_engines, replica_reads, use_replica
+from app.models.user_models import User
+
+
+def names(engine):
+    return sorted(name for name, in engine.execute(User.__table__.select().with_only_columns([User.first_name])))
+
+
+@pytest.fixture
+def routed_app(tmp_path):
+    """An app whose primary and replica are separate SQLite files, so every row shows where it was read or written"""
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///%s' % (tmp_path / 'primary.db',),
+                      SQLALCHEMY_REPLICA_URIS='sqlite:///%s' % (tmp_path / 'replica.db',),
+                      SQLALCHEMY_REPLICA_STICKY_SECONDS=60, SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    configure_engines(app)
+    db.init_app(app)
+    # The scoped session belongs to the thread, so drop the one the test application may have left behind.
+    db.session.remove()
+    app.primary = db.get_engine(app)
+    app.replica = db.get_engine(app, bind='replica_0')
+    for engine, name in ((app.primary, 'primary'), (app.replica, 'replica')):
+        User.__table__.create(engine)
+        engine.execute(User.__table__.insert().values(first_name=name, last_name='', password='', is_active=True))
+
+    def first_names():
+        return [user.first_name for user in User.query.order_by(User.id)]
+
+    @app.route('/read')
+    def read():
+        return jsonify(first_names())
+
+    @app.route('/replica')
+    @use_replica
+    def read_replica():
+        return jsonify(first_names())
+
+    @app.route('/write')
+    @use_replica
+    def write():
+        before = first_names()
+        db.session.add(User(first_name='written', last_name='', password='', active=True))
+        db.session.commit()
+        return jsonify({'before': before, 'after': first_names()})
+
+    @app.route('/update')
+    def update():
+        with replica_reads():
+            before = first_names()
+            User.query.filter(User.first_name == 'primary').update({User.last_name: 'updated'},
+                                                                   synchronize_session=False)
+            db.session.commit()
+            after = first_names()
+        return jsonify({'before': before, 'after': after})
+
+    yield app
+    db.session.remove()
+
+
+def test_reads_use_the_replica_only_when_asked(routed_app):
+    client = routed_app.test_client()
+    assert client.get('/read').get_json() == ['primary']
+    assert client.get('/replica').get_json() == ['replica']
+
+
+def test_flushes_and_commits_go_to_the_primary(routed_app):
+    client = routed_app.test_client()
+    response = client.get('/write')
+    assert response.get_json() == {'before': ['replica'], 'after': ['primary', 'written']}
+    assert names(routed_app.primary) == ['primary', 'written']
+    assert names(routed_app.replica) == ['replica']
+
+
+def test_core_updates_go_to_the_primary(routed_app):
+    client = routed_app.test_client()
+    assert client.get('/update').get_json() == {'before': ['replica'], 'after': ['primary']}
+    updated = routed_app.primary.execute(User.__table__.select().where(User.last_name == 'updated')).fetchall()
+    assert len(updated) == 1
+    assert routed_app.replica.execute(User.__table__.select().where(User.last_name == 'updated')).fetchall() == []
+
+
+def test_browsers_that_wrote_read_from_the_primary(routed_app):
+    client = routed_app.test_client()
+    response = client.get('/write')
+    assert PRIMARY_COOKIE in response.headers.get('Set-Cookie', '')
+    assert client.get('/replica').get_json() == ['primary', 'written']
+
+    client.delete_cookie('localhost', PRIMARY_COOKIE)
+    assert client.get('/replica').get_json() == ['replica']
@@ -0,0 +1,120 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import pytest
+
+from app.extensions.error_mail import ErrorDigestHandler, ErrorQueueHandler
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def target():
+    return ListHandler()
+
+
+def make_logger(digest):
+    handler = ErrorQueueHandler(digest)
+    logger = logging.getLogger('test_error_mail.%d' % (id(handler),))
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger, handler
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+def log_failures(logger, values):
+    for value in values:
+        try:
+            fail(value)
+        except ValueError:
+            logger.exception('Exception on /users/%s [GET]', value)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_identical_tracebacks_are_summarized_once(target):
+    logger, handler = make_logger(ErrorDigestHandler(target, window=0.1))
+    log_failures(logger, range(5))
+    logger.error('Disk %d is full', 1)
+    logger.error('Disk %d is full', 2)
+
+    assert wait_for(lambda: target.records)
+    handler.stop()
+
+    assert len(target.records) == 1
+    summary = target.records[0]
+    assert summary.subject == 'System Error (7 errors)'
+    assert '5 x, first at' in summary.getMessage()
+    assert '2 x, first at' in summary.getMessage()
+    assert summary.getMessage().count('ValueError: 0') == 1
+
+
+def test_summaries_over_the_hourly_limit_are_deferred(target):
+    digest = ErrorDigestHandler(target, window=0.05, max_emails=1)
+    logger, handler = make_logger(digest)
+    log_failures(logger, [1])
+    assert wait_for(lambda: target.records)
+
+    log_failures(logger, [2, 3])
+    time.sleep(0.2)
+
+    assert len(target.records) == 1
+    assert [group['count'] for group in digest.groups.values()] == [2]
+    assert digest.timer is not None
+    digest.timer.cancel()
+    digest.timer = None
+    digest.reset()
+    handler.stop()
+
+
+def test_extra_kinds_of_error_are_only_counted(target):
+    digest = ErrorDigestHandler(target, window=10, max_groups=1)
+    logger, handler = make_logger(digest)
+    logger.error('First problem')
+    logger.error('Second problem')
+    logger.error('Third problem')
+    handler.stop()
+
+    message = target.records[0].getMessage()
+    assert '3 errors of 2 kinds' in message
+    assert '2 errors of other kinds are not shown.' in message
+
+
+def test_records_dropped_from_a_full_queue_are_counted_under_the_digest_lock(target):
+    digest = ErrorDigestHandler(target, window=60)
+    handler = ErrorQueueHandler(digest, maxsize=1)
+    handler.pid = os.getpid()
+    handler.queue = queue.Queue(1)
+    handler.queue.put_nowait(None)
+    record = logging.makeLogRecord({'msg': 'dropped', 'levelno': logging.ERROR})
+
+    digest.acquire()
+    try:
+        thread = threading.Thread(target=handler.enqueue, args=(record,))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        assert digest.dropped == 0
+    finally:
+        digest.release()
+    thread.join()
+    assert digest.dropped == 1
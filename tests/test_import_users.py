@@ -0,0 +1,63 @@
+from app.commands.user import import_users
+from app.models.user_models import User
+
+
+def run_import(records, **kwargs):
+    return import_users([dict(record) for record in records], processes=1, **kwargs)
+
+
+def role_names(user):
+    return sorted(role.name for role in user.roles)
+
+
+def test_import_can_be_run_again(db):
+    records = [
+        {'username': 'import-one', 'email': 'import-one@example.com', 'password': 'Password1', 'roles': ['editor']},
+        {'username': 'import-two', 'email': 'import-two@example.com', 'password': 'Password1', 'roles': []},
+    ]
+    assert run_import(records) == {'created': 2, 'updated': 0, 'skipped': 0, 'rejected': 0}
+    assert run_import(records) == {'created': 0, 'updated': 2, 'skipped': 0, 'rejected': 0}
+    assert User.query.filter(User.email.in_(['import-one@example.com', 'import-two@example.com'])).count() == 2
+    assert role_names(User.query.filter_by(username='import-one').one()) == ['editor']
+
+
+def test_records_sharing_an_email_become_one_user(db):
+    totals = run_import([
+        {'username': 'import-shared-a', 'email': 'import-shared@example.com', 'password': 'Password1', 'roles': []},
+        {'username': 'import-shared-b', 'email': 'import-shared@example.com', 'password': 'Password1', 'roles': []},
+    ])
+    assert totals['created'] == 1
+    assert User.query.filter_by(email='import-shared@example.com').one().username == 'import-shared-a'
+
+
+def test_roles_of_duplicate_records_are_merged(db):
+    run_import([
+        {'username': 'import-roles', 'email': 'import-roles@example.com', 'password': 'Password1',
+         'roles': ['editor']},
+        {'username': 'import-roles', 'email': 'import-roles@example.com', 'password': 'Password1',
+         'roles': ['auditor']},
+        {'email': 'import-roles@example.com', 'roles': ['editor', 'reviewer']},
+    ])
+    assert role_names(User.query.filter_by(username='import-roles').one()) == ['auditor', 'editor', 'reviewer']
+
+
+def test_new_users_without_a_password_are_rejected(db):
+    totals = run_import([
+        {'username': 'import-nopass', 'email': 'import-nopass@example.com', 'roles': ['editor']},
+        {'first_name': 'Nobody', 'roles': []},
+    ])
+    assert totals == {'created': 0, 'updated': 0, 'skipped': 1, 'rejected': 1}
+    assert User.query.filter_by(username='import-nopass').first() is None
+
+
+def test_passwords_of_existing_users_are_only_reset_when_asked(app, db):
+    record = {'username': 'import-password', 'email': 'import-password@example.com', 'password': 'Password1',
+              'roles': []}
+    run_import([record])
+    run_import([dict(record, password='Password2')])
+    user = User.query.filter_by(username='import-password').one()
+    assert app.user_manager.verify_password('Password1', user.password)
+
+    run_import([dict(record, password='Password2')], update_passwords=True)
+    db.session.refresh(user)
+    assert app.user_manager.verify_password('Password2', user.password)
@@ -0,0 +1,142 @@
+import re
+
+import pytest
+
+from app.extensions import ldap_sync
+from app.extensions.query_tracking import query_budget
+from app.models.user_models import ApiKey, LdapSyncState, User
+from app.utils.api import create_api_token, get_api_key_epoch, get_token_serializer, hash_api_key
+
+_modified_since = re.compile(r'modifyTimestamp>=([^)]+)')
+
+
+def entry(**attributes):
+    return {'raw_attributes': {name: [value.encode('utf-8') for value in (values if isinstance(values, list) else [values])]
+                               for name, values in attributes.items()}}
+
+
+class StubDirectory(object):
+    """Stands in for LdapConnectionPool, answering paged searches from lists of users and groups"""
+
+    def __init__(self):
+        self.users = []
+        self.groups = {}
+        self.searches = []
+
+    def add_user(self, uid, modified):
+        self.users.append(entry(uid=uid, mail='%s@example.com' % (uid,), modifyTimestamp=modified))
+
+    def set_group(self, name, members, modified):
+        self.groups[name] = entry(cn=name, memberUid=members, modifyTimestamp=modified)
+
+    def paged_search(self, search_base, search_filter, search_scope=None, attributes=None, page_size=None):
+        self.searches.append((search_base, search_filter))
+        if search_base == 'ou=users,dc=example':
+            entries = self.users
+        else:
+            group = self.groups.get(search_base.split(',')[0][len('cn='):])
+            entries = [group] if group else []
+        since = _modified_since.search(search_filter)
+        for result in entries:
+            if not since or result['raw_attributes']['modifyTimestamp'][0].decode('utf-8') >= since.group(1):
+                yield result
+
+
+@pytest.fixture
+def directory(app, db, monkeypatch):
+    LdapSyncState.query.delete()
+    db.session.commit()
+    directory = StubDirectory()
+    monkeypatch.setattr(ldap_sync, 'get_connection_pool', lambda: directory)
+    for setting, value in {'LDAP_USERNAME_ATTRIBUTE': 'uid', 'LDAP_USER_OBJECT_CLASS': 'inetOrgPerson',
+                           'LDAP_USER_BASE': 'ou=users,dc=example', 'LDAP_GROUP_OBJECT_CLASS': 'posixGroup',
+                           'LDAP_GROUP_ATTRIBUTE': 'cn', 'LDAP_GROUP_BASE': 'ou=groups,dc=example',
+                           'LDAP_EMAIL_ATTRIBUTE': 'mail', 'LDAP_GROUP_TO_ROLE_ADMIN': False,
+                           'LDAP_GROUP_TO_ROLE_DEV': 'ldap-developers', 'LDAP_GROUP_TO_ROLE_USER': False}.items():
+        monkeypatch.setitem(app.config, setting, value)
+    return directory
+
+
+def role_names(username):
+    return sorted(role.name for role in User.query.filter_by(username=username).one().roles)
+
+
+def test_users_losing_a_role_get_their_tokens_revoked(directory, db):
+    directory.add_user('ldap-revoked', '20240101000000Z')
+    directory.add_user('ldap-kept', '20240101000000Z')
+    directory.set_group('ldap-developers', ['ldap-revoked', 'ldap-kept'], '20240101000000Z')
+    ldap_sync.sync_directory(full=True)
+    assert role_names('ldap-revoked') == ['dev']
+
+    tokens = {}
+    for username in ('ldap-revoked', 'ldap-kept'):
+        api_key = ApiKey(id=username, hash=hash_api_key(username), user_id=User.query.filter_by(username=username).one().id)
+        db.session.add(api_key)
+        db.session.commit()
+        tokens[username] = get_token_serializer().loads(create_api_token(api_key))
+        assert get_api_key_epoch(username) == tokens[username]['e']
+
+    directory.set_group('ldap-developers', ['ldap-kept'], '20240102000000Z')
+    ldap_sync.sync_directory()
+
+    assert role_names('ldap-revoked') == []
+    assert get_api_key_epoch('ldap-revoked') != tokens['ldap-revoked']['e']
+    assert get_api_key_epoch('ldap-kept') == tokens['ldap-kept']['e']
+
+
+def test_incremental_syncs_continue_from_the_newest_timestamp(directory):
+    directory.add_user('ldap-first', '20240201000000Z')
+    directory.add_user('ldap-second', '20240202000000Z')
+    directory.set_group('ldap-developers', ['ldap-first'], '20240201000000Z')
+    assert ldap_sync.sync_directory() == {'users': 2, 'roles': 1, 'last_modified': '20240202000000Z'}
+    assert LdapSyncState.query.get('directory').last_modified == '20240202000000Z'
+
+    directory.add_user('ldap-third', '20240203000000Z')
+    directory.searches = []
+    # Entries stamped with the newest time seen are read again, as others may share that second.
+    assert ldap_sync.sync_directory() == {'users': 2, 'roles': 0, 'last_modified': '20240203000000Z'}
+    assert all('(modifyTimestamp>=20240202000000Z)' in search_filter for base, search_filter in directory.searches)
+    assert role_names('ldap-first') == ['dev']
+    assert User.query.filter_by(username='ldap-third').one().email == 'ldap-third@example.com'
+
+
+def test_members_removed_from_a_group_lose_its_role(directory):
+    for username in ('ldap-a', 'ldap-b', 'ldap-c'):
+        directory.add_user(username, '20240301000000Z')
+    directory.set_group('ldap-developers', ['ldap-a', 'ldap-b', 'ldap-c'], '20240301000000Z')
+    ldap_sync.sync_directory()
+    assert [role_names(username) for username in ('ldap-a', 'ldap-b', 'ldap-c')] == [['dev'], ['dev'], ['dev']]
+
+    directory.set_group('ldap-developers', ['ldap-a', 'ldap-unknown'], '20240302000000Z')
+    ldap_sync.sync_directory()
+    assert [role_names(username) for username in ('ldap-a', 'ldap-b', 'ldap-c')] == [['dev'], [], []]
+
+
+def test_memberships_are_deleted_in_chunks(directory, monkeypatch):
+    monkeypatch.setattr(ldap_sync, 'QUERY_CHUNK_SIZE', 2)
+    usernames = ['ldap-chunk-%d' % (number,) for number in range(5)]
+    for username in usernames:
+        directory.add_user(username, '20240401000000Z')
+    directory.set_group('ldap-developers', usernames, '20240401000000Z')
+    ldap_sync.sync_directory()
+    assert all(role_names(username) == ['dev'] for username in usernames)
+
+    directory.set_group('ldap-developers', [], '20240402000000Z')
+    with query_budget(1000) as recorder:
+        ldap_sync.sync_directory()
+    deletes = [statement for statement in recorder.statements if statement.startswith('DELETE FROM users_roles')]
+    assert len(deletes) == 3
+    assert all(role_names(username) == [] for username in usernames)
+
+
+def test_full_syncs_deactivate_users_missing_from_the_directory(directory):
+    directory.add_user('ldap-staying', '20240501000000Z')
+    directory.add_user('ldap-leaving', '20240501000000Z')
+    ldap_sync.sync_directory(full=True)
+
+    directory.users = directory.users[:1]
+    ldap_sync.sync_directory()
+    assert User.query.filter_by(username='ldap-leaving').one().active
+    ldap_sync.sync_directory(full=True)
+    assert not User.query.filter_by(username='ldap-leaving').one().active
+    assert User.query.filter_by(username='ldap-staying').one().active
@@ -0,0 +1,134 @@
+import socketserver
+import threading
+
+import pytest
+from flask import Flask
+from flask_mail import Message
+
+from app import mail
+from app.tasks.mail import send_messages
+from app.extensions.mail import _connections, close_connection, deliver, message_from_dict, message_to_dict, \
+    send_message
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server to accept mail and count the connections it was sent over"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.drop_after_message = False
+        self.refused_sender = None
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').strip().upper()
+            if command.startswith('EHLO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                self.server.messages.append(b''.join(data))
+                self.reply('250 queued')
+                if self.server.drop_after_message:
+                    return
+            elif self.server.refused_sender and command.startswith('MAIL FROM') and \
+                    self.server.refused_sender.upper() in command:
+                self.reply('550 sender refused')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mail_app(smtp_server):
+    app = Flask(__name__)
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=smtp_server.server_address[1], MAIL_USE_TLS=False,
+                      MAIL_USE_SSL=False, MAIL_USERNAME=None, MAIL_PASSWORD=None,
+                      MAIL_DEFAULT_SENDER='sender@example.com')
+    mail.init_app(app)
+    with app.app_context():
+        yield app
+        close_connection()
+
+
+def make_message(number):
+    return Message('Message %d' % (number,), recipients=['user%d@example.com' % (number,)], body='Body %d' % (number,))
+
+
+def test_batches_share_one_connection(mail_app, smtp_server):
+    assert deliver([make_message(number) for number in range(3)]) == 3
+    assert deliver([make_message(3)]) == 1
+
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 4
+    assert b'Subject: Message 3' in smtp_server.messages[3]
+
+
+def test_dropped_connection_is_replaced(mail_app, smtp_server):
+    smtp_server.drop_after_message = True
+    assert deliver([make_message(number) for number in range(2)]) == 2
+
+    assert smtp_server.connections == 2
+    assert len(smtp_server.messages) == 2
+
+
+def test_messages_sent_without_a_broker_close_their_connection(mail_app, smtp_server):
+    assert send_message(make_message(1)) == 1
+    assert send_message(make_message(2)) == 1
+
+    assert _connections.connection is None
+    assert smtp_server.connections == 2
+    assert len(smtp_server.messages) == 2
+
+
+def test_failed_messages_are_reported_without_resending_the_others(mail_app, smtp_server):
+    smtp_server.refused_sender = 'refused@example.com'
+    messages = [make_message(number) for number in range(3)]
+    messages[1].sender = 'refused@example.com'
+
+    assert send_messages([message_to_dict(message) for message in messages]) == [1]
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 1
+
+
+def test_queued_messages_survive_serialization():
+    message = Message('Hello', sender=('Sender', 'sender@example.com'), recipients=['user@example.com'],
+                      html='<b>Hi</b>', body='Hi', extra_headers={'X-Test': '1'})
+    message.attach('report.txt', 'text/plain', b'contents')
+
+    copy = message_from_dict(message_to_dict(message))
+
+    assert copy.msgId == message.msgId
+    assert copy.attachments[0].data == b'contents'
+    assert (copy.subject, copy.html, copy.body, copy.extra_headers) == ('Hello', '<b>Hi</b>', 'Hi', {'X-Test': '1'})
@@ -0,0 +1,43 @@
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine
+
+from app.extensions.metrics import init_metrics
+
+
+@pytest.fixture(scope='module')
+def metrics_client():
+    app = Flask(__name__)
+    app.config.update(TESTING=True, METRICS_TOKEN='metrics-token')
+    init_metrics(app)
+    engine = create_engine('sqlite://')
+
+    @app.route('/instrumented')
+    def instrumented():
+        with engine.connect() as connection:
+            for _ in range(3):
+                connection.execute('SELECT 1')
+        return 'ok'
+
+    return app.test_client()
+
+
+def test_metrics_are_disabled_without_a_token(client):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_require_the_token(metrics_client):
+    assert metrics_client.get('/metrics').status_code == 401
+    assert metrics_client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert metrics_client.get('/metrics', headers={'Authorization': 'metrics-token'}).status_code == 401
+
+
+def test_requests_are_recorded(metrics_client):
+    assert metrics_client.get('/instrumented').status_code == 200
+    response = metrics_client.get('/metrics', headers={'Authorization': 'Bearer metrics-token'})
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert 'http_request_duration_seconds_count{endpoint="instrumented",method="GET",status="200"} 1.0' in lines
+    assert 'http_request_sql_queries_sum{endpoint="instrumented"} 3.0' in lines
+    assert 'http_request_sql_queries_bucket{endpoint="instrumented",le="2.0"} 0.0' in lines
+    assert 'http_request_sql_queries_bucket{endpoint="instrumented",le="3.0"} 1.0' in lines
@@ -0,0 +1,64 @@
+from flask import jsonify
+import pytest
+
+from app.extensions.query_tracking import query_budget
+from app.models.user_models import User
+from app.utils.permissions import Permissions
+
+
+@pytest.fixture(scope='module')
+def permissions_route(app):
+    """Registers a route that checks a user's roles several times within one request."""
+    if 'test_permissions' not in app.view_functions:
+        @app.route('/test/permissions/<int:user_id>')
+        def test_permissions(user_id):
+            user = User.query.get(user_id)
+            with query_budget(100) as recorder:
+                results = [user.has_roles('admin'), user.has_roles(('editor', 'admin')), user.has_role('editor'),
+                           'admin' in user.permissions]
+            return jsonify({'queries': recorder.count, 'results': results})
+    return app
+
+
+def test_role_name_requirements_must_all_be_held():
+    permissions = Permissions(['editor', 'auditor'])
+    assert permissions.has_roles('editor')
+    assert permissions.has_roles('editor', 'auditor')
+    assert not permissions.has_roles('editor', 'reviewer')
+    assert not Permissions().has_roles('editor')
+
+
+def test_tuple_requirements_need_one_of_their_roles():
+    permissions = Permissions(['editor'])
+    assert permissions.has_roles(('reviewer', 'editor'))
+    assert permissions.has_roles(['reviewer', 'editor'])
+    assert not permissions.has_roles(('reviewer', 'auditor'))
+    assert permissions.has_roles('editor', ('reviewer', 'editor'))
+    assert not permissions.has_roles('reviewer', ('reviewer', 'editor'))
+
+
+def test_admins_meet_every_requirement():
+    permissions = Permissions(['admin'])
+    assert permissions.has_roles('editor', ('reviewer', 'auditor'))
+    assert permissions.has_any(['editor'])
+    assert not permissions.has_role('editor', allow_admin=False)
+    assert not permissions.has_any(['editor'], allow_admin=False)
+
+
+def test_users_check_roles_like_permissions():
+    member = User.query.filter_by(email='member@example.com').one()
+    admin = User.query.filter_by(email='admin@example.com').one()
+    assert not member.has_roles('admin')
+    assert not member.has_roles(('admin', 'editor'))
+    assert member.has_roles()
+    assert admin.has_roles('admin', 'editor', ('reviewer', 'auditor'))
+
+
+def test_roles_are_loaded_once_per_request(permissions_route, client):
+    admin = User.query.filter_by(email='admin@example.com').one()
+    member = User.query.filter_by(email='member@example.com').one()
+
+    response = client.get('/test/permissions/%d' % (admin.id,)).get_json()
+    assert response == {'queries': 1, 'results': [True, True, True, True]}
+    response = client.get('/test/permissions/%d' % (member.id,)).get_json()
+    assert response == {'queries': 1, 'results': [False, False, False, False]}
@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import create_engine
+
+from app.extensions.query_tracking import QueryBudgetExceeded, normalize_statement, query_budget
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    engine.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+    engine.execute("INSERT INTO items (id, name) VALUES (1, 'one'), (2, 'two'), (3, 'three')")
+    return engine
+
+
+def test_statements_with_different_parameters_share_a_shape():
+    assert normalize_statement("SELECT * FROM items WHERE id = 1 AND name = 'it''s'") == \
+        normalize_statement("SELECT *\n  FROM items WHERE id = 22 AND name = 'other'")
+    assert normalize_statement('SELECT * FROM items WHERE id IN (?, ?, ?)') == \
+        normalize_statement('SELECT * FROM items WHERE id IN (?, ?)')
+
+
+def test_repeated_shapes_are_flagged(engine):
+    with query_budget(10) as recorder:
+        for item_id in range(1, 4):
+            engine.execute('SELECT name FROM items WHERE id = ?', item_id)
+        engine.execute('SELECT count(*) FROM items')
+
+    assert recorder.count == 4
+    assert recorder.repeated(3) == [('SELECT name FROM items WHERE id = ?', 3)]
+
+
+def test_exceeding_the_budget_fails(engine):
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget(2):
+            for item_id in range(1, 4):
+                engine.execute('SELECT name FROM items WHERE id = ?', item_id)
+
+
+def test_budget_decorator_counts_each_call(engine):
+    @query_budget(1)
+    def load(item_id):
+        return engine.execute('SELECT name FROM items WHERE id = ?', item_id).scalar()
+
+    assert [load(item_id) for item_id in range(1, 4)] == ['one', 'two', 'three']
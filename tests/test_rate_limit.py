@@ -0,0 +1,59 @@
+import pytest
+from flask import Flask
+from werkzeug.exceptions import TooManyRequests
+
+from app.extensions import rate_limit
+from app.extensions.rate_limit import DatabaseBuckets, MemoryBuckets, enforce_api_rate_limits, parse_limit
+from app.models.user_models import RateLimitBucket
+
+
+def test_limits_can_be_written_as_tuples_or_strings():
+    assert parse_limit((60, 60)) == parse_limit('60/60') == (60, 60.0)
+    assert parse_limit(False) is None
+
+
+def test_bucket_allows_a_burst_then_refills():
+    buckets = MemoryBuckets()
+    assert [buckets.take('ip:1', 3, 1.0, 100) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('ip:1', 3, 1.0, 100) == 1.0
+    assert buckets.take('ip:1', 3, 1.0, 100.5) == 0.5
+    assert buckets.take('ip:1', 3, 1.0, 101) == 0
+    assert buckets.take('ip:2', 3, 1.0, 101) == 0
+
+
+def test_least_recently_used_buckets_are_forgotten():
+    buckets = MemoryBuckets(maxsize=2)
+    for key in ('a', 'b', 'c'):
+        buckets.take(key, 1, 1.0, 100)
+    assert list(buckets.buckets) == ['b', 'c']
+
+
+def test_refunds_never_overfill_a_bucket():
+    buckets = MemoryBuckets()
+    buckets.take('ip:1', 2, 1.0, 100)
+    buckets.refund('ip:1', 2)
+    buckets.refund('ip:1', 2)
+    assert buckets.buckets['ip:1'] == (2, 100)
+
+
+def test_database_buckets_take_and_refund(db):
+    buckets = DatabaseBuckets()
+    assert [buckets.take('test:refund', 2, 1.0, 100) for _ in range(3)] == [0, 0, 1.0]
+    buckets.refund('test:refund', 2)
+    assert db.session.query(RateLimitBucket.tokens).filter_by(key='test:refund').scalar() == 1
+
+
+def test_requests_refused_by_the_key_limit_keep_their_ip_token(monkeypatch):
+    app = Flask(__name__)
+    app.config.update(API_RATE_LIMIT_BACKEND='memory', API_RATE_LIMIT_IP=(10, 60))
+    monkeypatch.setattr(rate_limit, 'get_key_limit', lambda key_id: (1, 60))
+
+    environ = {'REMOTE_ADDR': '192.0.2.1'}
+    with app.test_request_context(headers={'API_ID': 'limited'}, environ_base=environ):
+        enforce_api_rate_limits()
+    for _ in range(3):
+        with app.test_request_context(headers={'API_ID': 'limited'}, environ_base=environ):
+            with pytest.raises(TooManyRequests):
+                enforce_api_rate_limits()
+    with app.app_context():
+        assert int(rate_limit.get_buckets().buckets['ip:192.0.2.1'][0]) == 9
@@ -0,0 +1,168 @@
+from beaker.session import Session as BeakerSession
+from datetime import datetime, timedelta
+from flask import Flask, session
+import pytest
+
+from app import db, init_session_manager
+from app.extensions.sessions import purge_expired_sessions, store_session
+from app.models.user_models import UserSession
+from app.tasks.sessions import purge_expired_sessions as purge_task
+
+
+def make_app(**config):
+    """A bare application with only the session backend configured, plus routes that read and write the session"""
+    app = Flask(__name__)
+    app.config.update(dict({'SECRET_KEY': 'session-test-secret'}, **config))
+    init_session_manager(app)
+
+    @app.route('/write/<value>')
+    def write(value):
+        session['value'] = value
+        return 'ok'
+
+    @app.route('/read')
+    def read():
+        return session.get('value', 'missing')
+
+    @app.route('/clear')
+    def clear():
+        session.clear()
+        return 'ok'
+
+    return app
+
+
+@pytest.fixture
+def beaker_saves(monkeypatch):
+    saves = []
+    save = BeakerSession.save
+    monkeypatch.setattr(BeakerSession, 'save', lambda self, *args, **kwargs: (saves.append(self.id),
+                                                                             save(self, *args, **kwargs)))
+    return saves
+
+
+def test_beaker_sessions_are_only_saved_when_changed(tmp_path, beaker_saves):
+    client = make_app(CACHE_TYPE='file', CACHE_ROOT=str(tmp_path)).test_client()
+
+    assert client.get('/read').data == b'missing'
+    assert beaker_saves == []
+
+    client.get('/write/one')
+    assert len(beaker_saves) == 1
+    assert client.get('/read').data == b'one'
+    client.get('/write/one')
+    assert len(beaker_saves) == 1
+
+    client.get('/write/two')
+    assert len(beaker_saves) == 2
+    assert client.get('/read').data == b'two'
+
+
+def test_unchanged_beaker_sessions_are_refreshed_after_the_interval(tmp_path, beaker_saves):
+    client = make_app(CACHE_TYPE='file', CACHE_ROOT=str(tmp_path), SESSION_REFRESH_INTERVAL=0).test_client()
+    client.get('/write/one')
+    client.get('/read')
+    assert len(beaker_saves) == 2
+
+
+def test_cookie_sessions_round_trip():
+    client = make_app(SESSION_BACKEND='cookie').test_client()
+    client.get('/write/one')
+    assert client.get('/read').data == b'one'
+
+    other_client = make_app(SESSION_BACKEND='cookie').test_client()
+    cookie = next(cookie for cookie in client.cookie_jar if cookie.name == 'session')
+    other_client.set_cookie('localhost', 'session', cookie.value)
+    assert other_client.get('/read').data == b'one'
+
+
+def test_tampered_cookie_sessions_are_rejected():
+    client = make_app(SESSION_BACKEND='cookie').test_client()
+    client.get('/write/one')
+    cookie = next(cookie for cookie in client.cookie_jar if cookie.name == 'session')
+    payload, signature = cookie.value.rsplit('.', 1)
+    forged = make_app(SESSION_BACKEND='cookie', SECRET_KEY='another-secret').test_client()
+    forged.get('/write/admin')
+    forged_cookie = next(cookie for cookie in forged.cookie_jar if cookie.name == 'session')
+
+    client.set_cookie('localhost', 'session', payload + '.' + signature[::-1])
+    assert client.get('/read').data == b'missing'
+    client.set_cookie('localhost', 'session', forged_cookie.value)
+    assert client.get('/read').data == b'missing'
+
+
+def session_cookie(client, name='session'):
+    return next(cookie.value for cookie in client.cookie_jar if cookie.name == name)
+
+
+@pytest.fixture
+def database_apps(tmp_path):
+    """Two app instances sharing one database, as two nodes behind a load balancer would"""
+    uri = 'sqlite:///%s' % (tmp_path / 'sessions.db',)
+    apps = [make_app(SESSION_BACKEND='database', SQLALCHEMY_DATABASE_URI=uri, SQLALCHEMY_TRACK_MODIFICATIONS=False)
+            for _ in range(2)]
+    for app in apps:
+        db.init_app(app)
+    UserSession.__table__.create(db.get_engine(apps[0]))
+    return apps
+
+
+def session_rows(app):
+    with app.app_context():
+        return db.session.query(UserSession.id, UserSession.expires_at).all()
+
+
+def test_database_sessions_are_shared_between_instances(database_apps):
+    first, second = [app.test_client() for app in database_apps]
+    first.get('/write/one')
+    assert len(session_rows(database_apps[0])) == 1
+
+    second.set_cookie('localhost', 'session', session_cookie(first))
+    assert second.get('/read').data == b'one'
+    second.get('/write/two')
+    assert first.get('/read').data == b'two'
+    assert len(session_rows(database_apps[1])) == 1
+
+    first.get('/clear')
+    assert session_rows(database_apps[0]) == []
+    assert second.get('/read').data == b'missing'
+
+
+def test_expired_database_sessions_are_not_loaded(database_apps):
+    client = database_apps[0].test_client()
+    client.get('/write/one')
+    with database_apps[0].app_context():
+        UserSession.query.update({UserSession.expires_at: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+    assert client.get('/read').data == b'missing'
+
+
+def test_unchanged_database_sessions_are_not_written_again(database_apps):
+    client = database_apps[0].test_client()
+    client.get('/write/one')
+    written = session_rows(database_apps[0])
+    client.get('/read')
+    client.get('/write/one')
+    assert session_rows(database_apps[0]) == written
+
+
+def test_tampered_database_session_cookies_are_rejected(database_apps):
+    client = database_apps[0].test_client()
+    client.get('/write/one')
+    sid, signature = session_cookie(client).rsplit('.', 1)
+    client.set_cookie('localhost', 'session', sid + '.' + signature[::-1])
+    assert client.get('/read').data == b'missing'
+
+
+def test_purging_only_removes_expired_sessions(database_apps):
+    now = datetime.utcnow()
+    with database_apps[0].app_context():
+        for number in range(5):
+            store_session('expired-%d' % (number,), b'j{}', now - timedelta(minutes=number + 1))
+        store_session('live', b'j{}', now + timedelta(hours=1))
+        assert purge_expired_sessions(batch_size=2) == 5
+        assert [row.id for row in UserSession.query] == ['live']
+
+        store_session('expired-again', b'j{}', now - timedelta(minutes=1))
+        assert purge_task() == 1
+        assert [row.id for row in UserSession.query] == ['live']
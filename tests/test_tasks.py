@@ -0,0 +1,151 @@
+import threading
+
+import pytest
+
+from app import celery, db
+from app.models.user_models import Role
+from app.tasks import base
+from app.tasks.base import BatchedTask
+
+
+@celery.task(name='tests.tasks.session_state')
+def session_state(fail=False):
+    db.session.add(Role(name='task-role', label='Task Role'))
+    db.session.flush()
+    if fail:
+        raise ValueError('task failed')
+    return db.session()
+
+
+def run_in_worker_thread(function):
+    """Run `function` on a thread without an application context, as a worker would"""
+    result = {}
+
+    def target():
+        try:
+            result['value'] = function()
+        except Exception as e:
+            result['error'] = e
+        result['session_left_open'] = db.session.registry.has()
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    return result
+
+
+@pytest.fixture
+def worker_app(app, monkeypatch):
+    monkeypatch.setattr(base, '_app', app)
+    return app
+
+
+def test_tasks_get_their_own_session_which_is_removed(worker_app, db):
+    result = run_in_worker_thread(lambda: session_state())
+    assert result['value'] is not db.session()
+    assert not result['session_left_open']
+    assert Role.query.filter_by(name='task-role').first() is None
+
+
+def test_failed_tasks_remove_their_session(worker_app, db):
+    result = run_in_worker_thread(lambda: session_state(fail=True))
+    assert isinstance(result['error'], ValueError)
+    assert not result['session_left_open']
+    assert Role.query.filter_by(name='task-role').first() is None
+
+
+def test_eager_tasks_share_the_callers_session(db):
+    try:
+        assert session_state.apply().get() is db.session()
+    finally:
+        db.session.rollback()
+
+
+class Handler(object):
+    """Batch handler that records its jobs and fails the ones it is told to"""
+
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = list(failing)
+
+    def __call__(self, jobs):
+        self.calls.append(jobs)
+        return [position for position, job in enumerate(jobs) if job in self.failing]
+
+
+@pytest.fixture
+def broker(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'CELERY_BROKER', 'memory://')
+    monkeypatch.setitem(celery.conf, 'broker_url', 'memory://')
+    monkeypatch.setitem(celery.conf, 'task_always_eager', False)
+
+
+def make_batched_task(handler, name, monkeypatch, **options):
+    task = BatchedTask(handler, name, options.pop('batch_size', 10), options.pop('flush_interval', 1.0), **options)
+    drains = []
+    monkeypatch.setattr(task.drain, 'apply_async', lambda **kwargs: drains.append(kwargs))
+    return task, drains
+
+
+def test_jobs_are_handled_immediately_without_a_broker(monkeypatch):
+    handler = Handler()
+    task, drains = make_batched_task(handler, 'tests.tasks.no_broker', monkeypatch)
+    task.enqueue({'job': 1})
+    task.enqueue({'job': 2})
+    assert handler.calls == [[{'job': 1}], [{'job': 2}]]
+    assert drains == []
+
+
+def test_drains_are_scheduled_once_per_flush_interval(broker, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(base.time, 'time', lambda: now[0])
+    handler = Handler()
+    task, drains = make_batched_task(handler, 'tests.tasks.throttled', monkeypatch, flush_interval=5)
+
+    for job in range(3):
+        task.enqueue(job)
+    assert drains == [{'countdown': 5}]
+    now[0] += 5
+    task.enqueue(3)
+    assert drains == [{'countdown': 5}, {'countdown': 5}]
+    assert handler.calls == []
+
+    assert task.drain_queue() == 4
+    assert handler.calls == [[0, 1, 2, 3]]
+    assert task.drain_queue() == 0
+
+
+def test_only_failed_jobs_are_retried(broker, monkeypatch, caplog):
+    handler = Handler(failing=[2])
+    task, drains = make_batched_task(handler, 'tests.tasks.partial', monkeypatch, max_attempts=3, retry_delay=30)
+    for job in range(4):
+        task.enqueue(job)
+
+    assert task.drain_queue() == 3
+    assert drains[-1] == {'countdown': 30}
+    assert task.drain_queue() == 0
+    assert handler.calls == [[0, 1, 2, 3], [2]]
+
+    # The third attempt is the last, after which the job is dropped instead of blocking the queue.
+    assert task.drain_queue() == 0
+    assert task.drain_queue() == 0
+    assert handler.calls[-1] == [2]
+    assert len(handler.calls) == 3
+    assert 'Dropped batch.tests.tasks.partial job after 3 attempts: 2' in caplog.text
+
+
+def test_jobs_are_retried_when_the_handler_raises(broker, monkeypatch):
+    calls = []
+
+    def handler(jobs):
+        calls.append(jobs)
+        if len(calls) == 1:
+            raise RuntimeError('handler failed')
+
+    task, drains = make_batched_task(handler, 'tests.tasks.raising', monkeypatch)
+    task.enqueue('a')
+    task.enqueue('b')
+    with pytest.raises(RuntimeError):
+        task.drain_queue()
+    assert task.drain_queue() == 2
+    assert calls == [['a', 'b'], ['a', 'b']]
@@ -0,0 +1,82 @@
+from flask import url_for
+import html
+import pytest
+import re
+from sqlalchemy import func
+
+from app.commands.user import find_or_create_user
+from app.models.user_models import User
+
+_email = re.compile(r'<td>([^<@]+@[^<]+)</td>')
+_link = re.compile(r'<a href="([^"]+)" class="btn btn-pill btn-sm btn-secondary(?: pull-right)?">(Previous|Next)</a>')
+
+
+@pytest.fixture(scope='module')
+def admin_client(app):
+    for number in range(11):
+        find_or_create_user(u'Page', u'%02d' % (number,), None, u'page-%02d@example.com' % (number,), 'Password1')
+    client = app.test_client()
+    response = client.post(url_for('user.login'), data={'email': 'admin@example.com', 'password': 'Password1'})
+    assert response.status_code == 302
+    return client
+
+
+def all_emails():
+    return [email for email, in User.query.with_entities(User.email).order_by(User.id)]
+
+
+def get_page(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    links = {name: html.unescape(href) for href, name in _link.findall(body)}
+    return _email.findall(body), links.get('Previous'), links.get('Next')
+
+
+def walk(client, url, direction):
+    pages = []
+    while url:
+        emails, previous_url, next_url = get_page(client, url)
+        pages.append((emails, previous_url, next_url))
+        url = next_url if direction == 'Next' else previous_url
+    return pages
+
+
+def test_pages_can_be_walked_forward_and_back(admin_client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'USER_ADMIN_PAGE_SIZE', 4)
+    emails = all_emails()
+
+    forward = walk(admin_client, '/users', 'Next')
+    assert len(forward) >= 3
+    assert [email for page, _, _ in forward for email in page] == emails
+    assert all(len(page) == 4 for page, _, _ in forward[:-1])
+    assert 1 <= len(forward[-1][0]) <= 4
+    assert forward[0][1] is None
+    assert forward[-1][2] is None
+    assert all(previous_url and 'before=' in previous_url for _, previous_url, _ in forward[1:])
+    assert all(next_url and 'after=' in next_url for _, _, next_url in forward[:-1])
+
+    backward = walk(admin_client, forward[-1][1], 'Previous')
+    assert [page for page, _, _ in reversed(backward)] == [page for page, _, _ in forward[:-1]]
+    assert backward[-1][1] is None
+    assert all(next_url for _, _, next_url in backward)
+
+
+def test_a_page_size_matching_the_table_gives_one_page(admin_client, app, monkeypatch):
+    emails = all_emails()
+    monkeypatch.setitem(app.config, 'USER_ADMIN_PAGE_SIZE', len(emails))
+    assert get_page(admin_client, '/users') == (emails, None, None)
+
+    monkeypatch.setitem(app.config, 'USER_ADMIN_PAGE_SIZE', len(emails) - 1)
+    first, previous_url, next_url = get_page(admin_client, '/users')
+    assert (first, previous_url) == (emails[:-1], None)
+    assert get_page(admin_client, next_url)[0] == emails[-1:]
+    assert get_page(admin_client, next_url)[2] is None
+
+
+def test_cursors_past_either_end_give_empty_pages(admin_client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'USER_ADMIN_PAGE_SIZE', 4)
+    first_id, last_id = User.query.with_entities(func.min(User.id), func.max(User.id)).one()
+    assert get_page(admin_client, '/users?after=%d' % (last_id,)) == ([], None, None)
+    emails, previous_url, next_url = get_page(admin_client, '/users?before=%d' % (first_id,))
+    assert (emails, previous_url) == ([], None)